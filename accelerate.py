@@ -7,15 +7,34 @@
 
 import os
 import cv2
+import numpy as np
+import subprocess
+from functools import partial
+from multiprocessing import Pool
 
 import time
 from datetime import timedelta
 
 from utils.ThreadVideoStream import ThreadVideoCapture, ThreadVideoWriter
+from utils.FFmpegVideoStream import FFmpegVideoWriter, encodeSelectedFrames
+from utils.frame_selector import selectFrames, def_seek_threshold
+from utils.overlay import SpeedOverlay, ClockOverlay
+from utils.roi_utils import videoDate
+from utils.video_probe import probeVideo
 
 from utils.log_utils import log, bcolors, logCoolMessage
+from utils.metrics import def_metrics, measured, progress, fpsPostfix
 from utils.yaml_utils import parseYaml, dumpYaml
 
+from find_frames import SPEED_FAST, SPEED_SLOW
+
+# Writer used for the segments: 'opencv' (cv2.VideoWriter with mp4v) or 'ffmpeg' (FFmpegVideoWriter with def_encoder settings)
+def_writer_backend = 'opencv'
+def_encoder = {}
+# Clips whose selected frames have a single speed and a constant step are rendered by an ffmpeg filter graph, without
+# decoding them in Python (only with the ffmpeg writer, both need the same encoder to be concatenated)
+def_filter_fast_path = True
+
 # def accelerate_video(input_video_path, output_video_path, timestamps, acceleration_factor_slow, acceleration_factor_fast, before_seconds=10, after_seconds=10):
 #     global new_fps
 
@@ -93,43 +112,273 @@ from utils.yaml_utils import parseYaml, dumpYaml
 #     log(f"  Finished {output_video_path}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
 
 
-def handleAcceleration(frames_dict, output_video_name, new_fps, acceleration_factor_fast, acceleration_factor_slow, include_fast = True, include_slow = True):
+"""
+    Returns the path of the segment of video for a given output video
+"""
+def segment_path(output_video_name, video):
+    # Segments are stored in a folder named as the output video
+    segments_path = os.path.join(os.path.dirname(output_video_name), 'segments', os.path.splitext(os.path.basename(output_video_name))[0])
+    return os.path.join(segments_path, '_'.join(video.split('/')[-4:]))
+
+"""
+    Arguments for accelerate_segment given the frames of video selected for each profile (None if not included).
+    Returns None if no profile has frames of this video
+"""
+def segmentArgs(video, profiles, frames_list, new_fps):
+    profile_frames = [(frames, segment_path(profile['output'], video), profile) 
+                      for profile, frames in zip(profiles, frames_list) if frames is not None and len(frames[0]) > 0]
+    if not profile_frames:
+        return None
+    return (video, profile_frames, new_fps)
+
+"""
+    Sets the writer used for the segments. encoder: codec, preset, crf, threads and pix_fmt of the ffmpeg backend
+    (see utils/FFmpegVideoStream.py). Has to be called before creating worker processes
+"""
+def setupAcceleration(writer_backend = 'opencv', encoder = {}, filter_fast_path = True):
+    global def_writer_backend, def_encoder, def_filter_fast_path
+
+    def_writer_backend = writer_backend
+    def_encoder = encoder
+    def_filter_fast_path = filter_fast_path
+
+"""
+    Video writer of the configured backend, not started
+"""
+def createWriter(path, fps, size):
+    if def_writer_backend == 'ffmpeg':
+        return FFmpegVideoWriter(path, fps, size, def_encoder)
+    return ThreadVideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+
+"""
+    Speed labels of a profile as {speed: (text, color)}, see utils/overlay.SpeedOverlay
+"""
+def speed_labels(profile):
+    labels = {}
+    if profile['include_fast']:
+        labels[SPEED_FAST] = (f'>>x{profile["fast"]}', (0,0,255))
+    if profile['include_slow']:
+        labels[SPEED_SLOW] = (f'>>x{profile["slow"]}', (0,255,0))
+    return labels
+
+"""
+    Returns (first_frame, step, speed) if all frames have the same speed and are taken each step frames, None otherwise.
+    Steps bigger than max_step are not considered uniform: selectFrames seeks over those gaps decoding less frames than
+    the filter graph, which decodes all of them
+"""
+def uniform_run(frame_indices, speeds, max_step = def_seek_threshold):
+    if len(frame_indices) < 2 or np.any(speeds != speeds[0]):
+        return None
+    steps = np.diff(frame_indices)
+    step = int(steps[0])
+    if step > max_step or np.any(steps != step):
+        return None
+    return int(frame_indices[0]), step, int(speeds[0])
+
+"""
+    Renders the segment of an output with encodeSelectedFrames if its frames are a uniform run (see uniform_run).
+    Returns True if the segment was written
+"""
+def filter_segment(video, output, new_fps, metadata):
+    run = uniform_run(output['frame_indices'], output['speeds'])
+    if run is None:
+        return False
+    first_frame, step, speed = run
+
+    label = SpeedOverlay(speed_labels(output['profile']), (metadata['width'], metadata['height'])).labelImage(speed)
+    overlay = None
+    if label is not None:
+        bgra, x, y = label
+        overlay = (f"{os.path.splitext(output['path'])[0]}.overlay.png", x, y)
+        cv2.imwrite(overlay[0], bgra)
+    try:
+        start = time.perf_counter()
+        written = encodeSelectedFrames(video, output['path'], first_frame, step, len(output['frame_indices']), new_fps, def_encoder, overlay)
+        if written:
+            def_metrics.add('render/filter_encode', time.perf_counter() - start, len(output['frame_indices']))
+        return written
+    finally:
+        if overlay is not None and os.path.exists(overlay[0]):
+            os.remove(overlay[0])
+
+"""
+    Renders the selected frames of one source video into one segment file per output profile. The video is
+    decoded once and each frame is sent to all profiles that selected it. Profiles with a uniform run of frames (and no
+    clock) are rendered by ffmpeg instead when the ffmpeg writer is used (see filter_segment).
+    profile_frames: list of (frames, segment_path, profile) with frames as (frame_indices, speeds)
+    Returns a list with the path of each segment or None if no frame could be written or the writer failed
+"""
+def accelerate_segment(args):
+    video, profile_frames, new_fps = args
     start = time.time()
 
-    cap = cv2.VideoCapture(list(frames_dict.keys())[0])
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    cap.release()
+    outputs = []
+    for (frame_indices, speeds), path, profile in profile_frames:
+        outputs.append({'frame_indices': frame_indices, 'speeds': speeds, 'next': 0, 'path': path, 'profile': profile, 'out': None, 'filtered': False})
+
+    metadata = probeVideo(video)
+    if def_writer_backend == 'ffmpeg' and def_filter_fast_path:
+        for output in outputs:
+            if not output['profile'].get('clock'):
+                output['filtered'] = filter_segment(video, output, new_fps, metadata)
+    frame_outputs = [output for output in outputs if not output['filtered']]
 
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    scale = 1
-    thickness = 2
-    text_size, _ = cv2.getTextSize(f'>>x{acceleration_factor_fast}', font, scale, thickness)
-    text_width, text_height = text_size
-    x = frame_width - text_width - 10  # 10 pixel margin
-    y = text_height + 10  # 10 pixel margin
+    # Clock needs the date of the video (from its path) and its frame rate
+    start_date = videoDate(video) if any(output['profile'].get('clock') for output in frame_outputs) else None
+    fps = metadata['fps'] if start_date is not None else None
 
+    # Each video is decoded once, front to back, retrieving only the frames selected by any profile. Seeking over big
+    # gaps is only exact with constant frame rate
+    all_indices = np.unique(np.concatenate([output['frame_indices'] for output in frame_outputs])) if frame_outputs else []
+    decode_start = time.perf_counter()
+    for frame_index, frame in selectFrames(video, all_indices, seek=metadata['constant_frame_rate']):
+        overlay_start = time.perf_counter()
+        def_metrics.add('render/decode', overlay_start - decode_start, 1)
+        targets = []
+        for output in frame_outputs:
+            # Frames of each profile are sorted, so only its next frame has to be checked
+            next_index = output['next']
+            if next_index < len(output['frame_indices']) and output['frame_indices'][next_index] == frame_index:
+                targets.append((output, output['speeds'][next_index]))
+                output['next'] += 1
 
-    out = ThreadVideoWriter(output_video_name, cv2.VideoWriter_fourcc(*'mp4v'), new_fps, (frame_width, frame_height))
-    out.start()
-    for video, frames in frames_dict.items():
+        for target_index, (output, speed) in enumerate(targets):
+            profile = output['profile']
+            # Frame is modified with the overlay and queued to be written, each profile needs its own copy
+            profile_frame = frame if target_index == len(targets) - 1 else frame.copy()
+
+            if output['out'] is None:
+                frame_height, frame_width = profile_frame.shape[:2]
+                # Overlays are rendered once for each segment
+                output['speed_overlay'] = SpeedOverlay(speed_labels(profile), (frame_width, frame_height))
+                output['clock_overlay'] = ClockOverlay(start_date, fps) if profile.get('clock') and start_date is not None else None
+                output['out'] = createWriter(output['path'], new_fps, (frame_width, frame_height))
+                output['out'].start()
+
+            output['speed_overlay'].apply(profile_frame, speed)
+            if output['clock_overlay'] is not None:
+                output['clock_overlay'].apply(profile_frame, frame_index)
+            def_metrics.add('render/overlay', time.perf_counter() - overlay_start, 1)
+
+            output['out'].write(profile_frame)
+            overlay_start = time.perf_counter()
+        decode_start = time.perf_counter()
+
+    segments = []
+    for output in outputs:
+        if output['filtered']:
+            segments.append(output['path'])
+        elif output['out'] is None:
+            segments.append(None)
+        else:
+            # Broken segments would make the concatenation of the whole output fail
+            segments.append(output['path'] if output['out'].release() else None)
+    def_metrics.video(video, 'render', time.time()-start, sum(len(output['frame_indices']) for output in outputs))
+    return segments
+
+"""
+    Joins all segments, in the given order, into the output video with ffmpeg concat (stream copy, no re-encoding)
+"""
+def concatenate_segments(segment_list, output_video_name, ffmpeg_cache_file):
+    start = time.time()
+
+    # Paths in the list file are relative to the list file itself, so they are stored as absolute paths
+    with open(ffmpeg_cache_file, 'w') as f:
+        for segment in segment_list:
+            f.write(f"file '{os.path.abspath(segment)}'\n")
+    
+    cmd_ffmpeg = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-fflags', '+igndts', '-y', '-f', 'concat', '-safe', '0', '-i', f'{ffmpeg_cache_file}', '-c', 'copy', f'{output_video_name}']
+    try:
+        result = subprocess.run(cmd_ffmpeg)
+    except FileNotFoundError:
+        log(f"Error concatenating {len(segment_list)} segments into {output_video_name}: ffmpeg executable not found", bcolors.ERROR)
+        return False
+    if result.returncode != 0:
+        log(f"Problem concatenating {len(segment_list)} segments into {output_video_name}", bcolors.ERROR)
+        return False
+    
+    log(f"Concatenated {len(segment_list)} segments into {output_video_name}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
+    return True
+
+"""
+    Appends segments to the end of the existing output videos without re-encoding them.
+    segment_lists: {output_video_name: segment_list}
+    Each result is written to a temporary file and outputs are only replaced once all of them were concatenated, so
+    they are never left half written and a failure leaves all of them as they were (the segments can be appended again).
+    Returns True if all outputs were updated
+"""
+def appendSegments(segment_lists, ffmpeg_cache_file):
+    tmp_videos = {}
+    for output_video_name, segment_list in segment_lists.items():
+        if not segment_list:
+            continue
+        root, extension = os.path.splitext(output_video_name)
+        tmp_video_name = f'{root}.tmp{extension}'
+        inputs = [output_video_name] + list(segment_list) if os.path.exists(output_video_name) else list(segment_list)
+        tmp_videos[output_video_name] = tmp_video_name
+        if not concatenate_segments(inputs, tmp_video_name, ffmpeg_cache_file):
+            for tmp_video_name in tmp_videos.values():
+                if os.path.exists(tmp_video_name):
+                    os.remove(tmp_video_name)
+            return False
+
+    for output_video_name, tmp_video_name in tmp_videos.items():
+        os.replace(tmp_video_name, output_video_name)
+    return True
+
+"""
+    Accelerates all videos for several output profiles. Each video is decoded once and rendered to one segment per
+    profile in parallel, then the segments of each profile are stitched in the original order into its output video.
+    profiles: list of dicts with 'output' (video path), 'slow' and 'fast' (acceleration factors) and 'include_slow'
+        and 'include_fast' (whether to add the speed overlay to slow/fast frames)
+    frames_dicts: frames selected for each profile as returned by find_frames.handleFrames
+"""
+def handleAcceleration(profiles, frames_dicts, new_fps, max_workers = 1, ffmpeg_cache_file = './cache/ffmpeg_video_list.txt', failed_videos_yaml = None, concatenate = True):
+    start = time.time()
+
+    for profile in profiles:
+        os.makedirs(os.path.dirname(segment_path(profile['output'], '')), exist_ok=True)
+
+    # Videos in the order of the first profile, all of them should have the same
+    videos = list(frames_dicts[0].keys())
+
+    args_list = []
+    for video in videos:
         # if '17d' not in video and '18d' not in video and '19d' not in video:
         #     continue
-        
-        cap = cv2.VideoCapture(video)
-        for frame_index in frames:
-            cap.set(cv2.CAP_PROP_FRAME_COUNT, frame_index[1])
-            ret, frame = cap.read()
-            if not ret:
-                log(f"Problem reading frame from {video}", bcolors.ERROR)
-            
-            if include_fast and frame_index[0] == 'f':
-                cv2.putText(frame, f'>>x{acceleration_factor_fast}', (x, y), font, scale, (0,0,255), thickness)
-            elif include_slow and frame_index[0] == 's':
-                cv2.putText(frame, f'>>x{acceleration_factor_slow}', (x, y), font, scale, (0,255,0), thickness)
+        args = segmentArgs(video, profiles, [frames_dict.get(video) for frames_dict in frames_dicts], new_fps)
+        if args is not None:
+            args_list.append(args)
+    
+    log(f"Accelerating {len(args_list)} videos into segments of {len(profiles)} outputs with {max_workers} workers.", bcolors.OKCYAN)
+    segment_lists = {profile['output']: [] for profile in profiles}
+    failed = []
+    with Pool(max_workers) as pool, progress(total=len(args_list), desc='Acceleration') as bar:
+        # imap keeps the original order of the videos
+        for args, (segments, snapshot) in zip(args_list, pool.imap(partial(measured, accelerate_segment), args_list)):
+            def_metrics.merge(snapshot)
+            bar.update()
+            bar.set_postfix(fpsPostfix(('render/decode', 'writer/encode')))
+            video, profile_frames, _ = args
+            for (_, _, profile), segment in zip(profile_frames, segments):
+                if segment is None:
+                    failed.append(video)
+                else:
+                    segment_lists[profile['output']].append(segment)
+    
+    failed = sorted(set(failed))
+    if failed:
+        log(f"Could not accelerate {len(failed)} videos.", bcolors.WARNING)
+    if failed_videos_yaml is not None:
+        dumpYaml(failed_videos_yaml, failed, 'w')
+
+    log(f"Accelerated {sum(len(segment_list) for segment_list in segment_lists.values())} segments, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
 
-            out.write(frame)
-    out.release()
+    if concatenate:
+        for output_video_name, segment_list in segment_lists.items():
+            if segment_list:
+                concatenate_segments(segment_list, output_video_name, ffmpeg_cache_file)
     
-    log(f"Accelerated video {output_video_name} videos, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
-    
\ No newline at end of file
+    def_metrics.add('stage/acceleration', time.time()-start)
+    log(f"Accelerated videos {', '.join(segment_lists.keys())}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
+    return segment_lists
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Micro benchmark of the per frame cost of the motion detection loop (crop, resize, background subtraction,
+    morphology and motion test) without decoding: frames of a video are decoded first and kept in memory.
+    Compares the previous implementation (new images for each step, erode/dilate iterations and np.sum) with
+    the current one (find_timetags ROI buffers and utils/motion_detectors.py).
+
+    Usage: python3 benchmark/detection_loop_benchmark.py video [--frames N] [--threads N]
+"""
+
+import os
+import sys
+import argparse
+
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import find_timetags
+from utils.motion_detectors import createDetector
+from utils.log_utils import log, bcolors, logCoolMessage
+
+def read_frames(video, count, frame_skip):
+    cap = cv2.VideoCapture(video)
+    frames = []
+    frame_index = 0
+    while len(frames) < count and cap.grab():
+        if frame_index % frame_skip == 0:
+            frames.append(cap.retrieve()[1])
+        frame_index += 1
+    cap.release()
+    return frames
+
+"""
+    Detection loop as it was before buffers were reused
+"""
+def previous_loop(frames, roi, threshold):
+    x, y, roi_width, roi_height = roi.crop
+    fgbg = cv2.createBackgroundSubtractorKNN(history=300, detectShadows=False)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    detections = []
+    for frame in frames:
+        frame = frame[y:y+roi_height, x:x+roi_width]
+        frame = cv2.resize(frame, (0, 0), fx=roi.scale, fy=roi.scale, interpolation=cv2.INTER_AREA)
+        motion_mask = fgbg.apply(frame)
+        motion_mask = cv2.erode(motion_mask, kernel, iterations=4)
+        motion_mask = cv2.dilate(motion_mask, kernel, iterations=4)
+        detections.append(np.sum(motion_mask) > threshold)
+    return detections
+
+def current_loop(frames, roi, threshold):
+    detector = createDetector('knn', threshold)
+    return [detector.detect(roi.apply(frame))[0] for frame in frames]
+
+"""
+    Time (seconds) spent in each step of the current loop
+"""
+def current_stages(frames, roi, threshold):
+    detector = createDetector('knn', threshold)
+    stages = {'crop and resize': 0, 'background subtraction': 0, 'opening': 0, 'motion test': 0}
+    for frame in frames:
+        start = time.perf_counter()
+        frame = roi.apply(frame)
+        crop_end = time.perf_counter()
+        motion_mask = detector.mask(frame)
+        mask_end = time.perf_counter()
+        motion_mask = cv2.morphologyEx(motion_mask, cv2.MORPH_OPEN, detector.kernel, dst=detector.buffer('opened', motion_mask.shape))
+        open_end = time.perf_counter()
+        cv2.countNonZero(motion_mask) * 255 > threshold
+        end = time.perf_counter()
+        for stage, elapsed in zip(stages.keys(), (crop_end - start, mask_end - crop_end, open_end - mask_end, end - open_end)):
+            stages[stage] += elapsed
+    return stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detection loop micro benchmark')
+    parser.add_argument('video')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=find_timetags.def_cv_threads, help='cv2.setNumThreads in the loop (as in each worker)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(args.threads)
+    frames = read_frames(args.video, args.frames, find_timetags.def_frame_skip)
+    roi = find_timetags.get_roi(args.video, (frames[0].shape[1], frames[0].shape[0]))
+    logCoolMessage(f'Detection loop, {len(frames)} frames, {args.threads} OpenCV threads')
+
+    results = {}
+    for name, loop in (('previous', previous_loop), ('current', current_loop)):
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            detections = loop(frames, roi, find_timetags.def_threshold)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = detections
+        log(f"{name:<10} {1000*best/len(frames):>7.3f} ms/frame ({len(frames)/best:.1f} frames/s), motion in {sum(detections)} frames", bcolors.OKCYAN)
+
+    log(f"Same detections: {results['previous'] == results['current']}")
+
+    for stage, elapsed in current_stages(frames, roi, find_timetags.def_threshold).items():
+        log(f"  {stage:<24} {1000*elapsed/len(frames):>7.3f} ms/frame")
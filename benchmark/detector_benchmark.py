@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Runs the motion detectors (see utils/motion_detectors.py) on a labelled sample of videos and reports sampled frames
+    per second, CPU time and precision/recall of the sampled frames with motion.
+    Labels file is a YAML dict of {video: [[first_frame, last_frame], ...]} with the frame intervals with motion (see
+    benchmark/labels_example.yaml).
+
+    Usage: python3 benchmark/detector_benchmark.py labels.yaml [--detectors knn mog2 ...] [--backend opencv|ffmpeg] [--motion-gate]
+"""
+
+import os
+import sys
+import argparse
+
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import find_timetags
+from find_timetags import setupTimetags, process_video
+from utils.motion_detectors import def_detectors
+from utils.yaml_utils import parseYaml
+from utils.log_utils import log, bcolors, logCoolMessage
+
+"""
+    Counts of sampled frames (true positive, false positive, false negative) for one video. Frame 0 is skipped as the
+    background model detects motion in its first frame
+"""
+def evaluate(data_dict, intervals, frame_skip):
+    sampled = np.arange(frame_skip, data_dict['total_frames'], frame_skip)
+    labelled = np.zeros(len(sampled), dtype=bool)
+    for first, last in intervals:
+        labelled |= (sampled >= first) & (sampled <= last)
+    detected = np.isin(sampled, data_dict['timestamps'])
+    return int(np.sum(labelled & detected)), int(np.sum(~labelled & detected)), int(np.sum(labelled & ~detected))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Motion detector benchmark')
+    parser.add_argument('labels')
+    parser.add_argument('--detectors', nargs='+', default=list(def_detectors.keys()), choices=list(def_detectors.keys()))
+    parser.add_argument('--backend', default='opencv', choices=['opencv', 'ffmpeg'])
+    parser.add_argument('--frame-skip', type=int, default=find_timetags.def_frame_skip)
+    parser.add_argument('--motion-gate', action='store_true')
+    args = parser.parse_args()
+
+    labels = parseYaml(args.labels)
+
+    rows = []
+    for detector in args.detectors:
+        logCoolMessage(f'Detector {detector}')
+        setupTimetags(False, args.frame_skip, args.backend, args.motion_gate, detector)
+        sampled, wall, cpu, true_positive, false_positive, false_negative = 0, 0, 0, 0, 0, 0
+        for video, intervals in labels.items():
+            start, start_cpu = time.perf_counter(), time.process_time()
+            data_dict = process_video(video)[video]
+            wall += time.perf_counter() - start
+            cpu += time.process_time() - start_cpu
+
+            sampled += data_dict['total_frames'] // args.frame_skip
+            tp, fp, fn = evaluate(data_dict, intervals or [], args.frame_skip)
+            true_positive, false_positive, false_negative = true_positive + tp, false_positive + fp, false_negative + fn
+
+        precision = true_positive / (true_positive + false_positive) if true_positive + false_positive else 1.0
+        recall = true_positive / (true_positive + false_negative) if true_positive + false_negative else 1.0
+        rows.append((detector, sampled / wall, cpu, precision, recall))
+
+    logCoolMessage('Motion detector benchmark')
+    log(f"{'detector':<12} {'fps':>8} {'cpu':>9} {'precision':>10} {'recall':>8}", bcolors.OKCYAN)
+    for detector, fps, cpu, precision, recall in rows:
+        log(f"{detector:<12} {fps:>8.1f} {cpu:>8.2f}s {precision:>10.3f} {recall:>8.3f}")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Compares the motion detector with and without the cheap motion gate (see find_timetags.py) on some videos.
+    Reports time, sampled frames per second and how many of the timestamps/intervals found without the gate are
+    also found with it (recall) and how many of the ones found with the gate were also found without it (precision).
+    
+    Usage: python3 benchmark/motion_gate_report.py [--backend opencv|ffmpeg] [--frame-skip N] video [video ...]
+"""
+
+import os
+import sys
+import argparse
+
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import find_timetags
+from find_timetags import setupTimetags, process_video
+from find_frames import updateIntervals
+from utils.log_utils import log, bcolors, logCoolMessage
+
+"""
+    Runs the detector on a video, returns (timestamps, data_dict, wall time, cpu time of this process)
+"""
+def run_detector(video, frame_skip, decode_backend, motion_gate):
+    setupTimetags(False, frame_skip, decode_backend, motion_gate)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    data_dict = process_video(video)[video]
+    return data_dict, time.perf_counter() - start, time.process_time() - start_cpu
+
+def ratio(found, total):
+    return found / total if total else 1.0
+
+"""
+    Fraction of reference intervals that overlap any of the intervals
+"""
+def interval_recall(reference, intervals):
+    reference = [interval for interval in reference if np.isfinite(interval[0])]
+    intervals = [interval for interval in intervals if np.isfinite(interval[0])]
+    found = sum(any(start <= other_end and other_start <= end for other_start, other_end in intervals) for start, end in reference)
+    return ratio(found, len(reference))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Motion gate comparison report')
+    parser.add_argument('videos', nargs='+')
+    parser.add_argument('--backend', default='opencv', choices=['opencv', 'ffmpeg'])
+    parser.add_argument('--frame-skip', type=int, default=find_timetags.def_frame_skip)
+    parser.add_argument('--before', type=float, default=1, help='Seconds before each timestamp (as before_seconds)')
+    parser.add_argument('--after', type=float, default=1, help='Seconds after each timestamp (as after_seconds)')
+    args = parser.parse_args()
+
+    rows = []
+    for video in args.videos:
+        logCoolMessage(video)
+        base, base_time, base_cpu = run_detector(video, args.frame_skip, args.backend, False)
+        gated, gated_time, gated_cpu = run_detector(video, args.frame_skip, args.backend, True)
+
+        # First timestamp is the 0 added when the background model starts
+        base_timestamps, gated_timestamps = set(base['timestamps'][1:].tolist()), set(gated['timestamps'][1:].tolist())
+        common = len(base_timestamps & gated_timestamps)
+        base_intervals = updateIntervals(dict(base), args.before, args.after)['merged_intervals']
+        gated_intervals = updateIntervals(dict(gated), args.before, args.after)['merged_intervals']
+
+        sampled = base['total_frames'] / args.frame_skip
+        rows.append({'video': video, 'sampled': sampled,
+                     'base_time': base_time, 'gated_time': gated_time, 'base_cpu': base_cpu, 'gated_cpu': gated_cpu,
+                     'base_timestamps': len(base_timestamps), 'gated_timestamps': len(gated_timestamps),
+                     'recall': ratio(common, len(base_timestamps)), 'precision': ratio(common, len(gated_timestamps)),
+                     'interval_recall': interval_recall(base_intervals, gated_intervals)})
+
+    logCoolMessage('Motion gate report')
+    header = f"{'video':<50} {'fps base':>9} {'fps gate':>9} {'cpu base':>9} {'cpu gate':>9} {'ts base':>8} {'ts gate':>8} {'recall':>7} {'prec.':>7} {'int.rec':>7}"
+    log(header, bcolors.OKCYAN)
+    for row in rows + [{'video': 'TOTAL', 'sampled': sum(row['sampled'] for row in rows),
+                        **{key: sum(row[key] for row in rows) for key in ('base_time', 'gated_time', 'base_cpu', 'gated_cpu', 'base_timestamps', 'gated_timestamps')},
+                        **{key: np.mean([row[key] for row in rows]) for key in ('recall', 'precision', 'interval_recall')}}]:
+        log(f"{row['video'][-50:]:<50} {row['sampled']/row['base_time']:>9.1f} {row['sampled']/row['gated_time']:>9.1f} "
+            f"{row['base_cpu']:>8.2f}s {row['gated_cpu']:>8.2f}s {row['base_timestamps']:>8} {row['gated_timestamps']:>8} "
+            f"{row['recall']:>7.3f} {row['precision']:>7.3f} {row['interval_recall']:>7.3f}")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Reproducible benchmark of the whole pipeline on synthetic footage (see benchmark/synthetic_footage.py). Each stage
+    runs through its real entry point (handleVideoSearch, handleTimetags, handleIntervals, handleFrames and
+    handleAcceleration) with empty caches, and the wall time, frames per second and peak RSS (main process and
+    worker processes) of each stage are reported. Detected motion (timestamps and merged intervals) is checked against
+    the ground truth of the footage, the benchmark fails (exit code 1) if detection does not match, so that a speedup
+    cannot silently break it.
+    Metrics of the run (see utils/metrics.py) are stored in work_dir/metrics_report.json.
+
+    Usage: python3 benchmark/pipeline_benchmark.py [--work-dir ./cache/benchmark] [--regenerate] [--backend opencv|ffmpeg]
+                                                   [--writer opencv|ffmpeg] [--detector knn|mog2|framediff|opticalflow]
+                                                   [--workers N] [--days N] [--seconds S] [--seed N]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import resource
+from datetime import datetime
+
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from find_videos import handleVideoSearch
+from find_timetags import handleTimetags
+from find_frames import handleIntervals, handleFrames
+from accelerate import handleAcceleration, setupAcceleration
+from utils.metrics import setupMetrics, writeMetricsReport
+from utils.motion_detectors import def_detectors
+from utils.yaml_utils import parseYaml
+from utils.log_utils import log, bcolors, logCoolMessage
+
+from synthetic_footage import generateFootage, def_fps, def_warmup_seconds
+
+"""
+    Peak RSS in MiB of this process and of the biggest finished child (worker processes once their pool is closed)
+"""
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+"""
+    Runs function(*args) as a benchmark stage, appends (name, seconds, frames, main_rss, workers_rss) to rows where
+    frames(result) gives the frames processed by the stage (None if it does not process frames)
+"""
+def run_stage(rows, name, frames, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    rows.append((name, seconds, frames(result) if frames is not None else None, *peak_rss()))
+    return result
+
+"""
+    Compares detected timestamps with the ground truth intervals. Timestamps up to tolerance frames after the end of an
+    interval are still matched (background model takes some frames to absorb the last position of a blob) and those
+    before warmup_frames are ignored (background model is still converging, there is no motion in the footage yet).
+    Returns (matched_intervals, total_intervals, false_timestamps) with false_timestamps the detections out of all intervals
+"""
+def check_detection(timestamp_dict, ground_truth, tolerance, warmup_frames):
+    matched, total, false_timestamps = 0, 0, 0
+    for video, intervals in ground_truth.items():
+        timestamps = np.asarray(timestamp_dict[video]['timestamps']) if video in timestamp_dict else np.array([], dtype=np.int32)
+        inside = np.zeros(len(timestamps), dtype=bool)
+        for first, last in intervals or []:
+            in_interval = (timestamps >= first) & (timestamps <= last + tolerance)
+            matched += bool(np.any(in_interval))
+            total += 1
+            inside |= in_interval
+        false_timestamps += int(np.sum(~inside & (timestamps >= warmup_frames)))
+    return matched, total, false_timestamps
+
+"""
+    Compares the merged intervals (see find_frames.updateIntervals) with the ground truth intervals: each ground truth
+    interval has to overlap a merged interval and each merged interval has to overlap a ground truth interval extended
+    before_seconds/after_seconds (plus tolerance frames). Intervals made only of detections before warmup_frames are
+    ignored. Returns (matched_intervals, total_intervals, false_intervals)
+"""
+def check_intervals(timestamp_dict, ground_truth, before_seconds, after_seconds, tolerance, warmup_frames):
+    matched, total, false_intervals = 0, 0, 0
+    for video, intervals in ground_truth.items():
+        data_dict = timestamp_dict.get(video, {})
+        fps = data_dict.get('fps', def_fps)
+        merged = [(start, end) for start, end in data_dict.get('merged_intervals', [])
+                  if np.isfinite(end) and end >= warmup_frames + after_seconds * fps]
+        intervals = intervals or []
+        for first, last in intervals:
+            matched += any(start <= last and end >= first for start, end in merged)
+            total += 1
+        extended = [(first - before_seconds * fps - tolerance, last + after_seconds * fps + tolerance) for first, last in intervals]
+        false_intervals += sum(not any(start <= last and end >= first for first, last in extended) for start, end in merged)
+    return matched, total, false_intervals
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pipeline benchmark on synthetic footage')
+    parser.add_argument('--work-dir', default='./cache/benchmark')
+    parser.add_argument('--regenerate', action='store_true', help='Generate footage again even if it already exists (needed after changing the footage options)')
+    parser.add_argument('--backend', default='opencv', choices=['opencv', 'ffmpeg'], help='Decode backend of timetags')
+    parser.add_argument('--writer', default='opencv', choices=['opencv', 'ffmpeg'], help='Writer backend of acceleration')
+    parser.add_argument('--detector', default='knn', choices=list(def_detectors.keys()), help='Motion detector of timetags')
+    parser.add_argument('--workers', type=int, default=max(os.cpu_count() - 1, 1))
+    parser.add_argument('--frame-skip', type=int, default=8)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--hours', type=int, nargs='+', default=[0, 10, 11])
+    parser.add_argument('--clips-per-hour', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--black-list', nargs='*', default=['/00h/'], help='Patterns of videos that are not analysed (night hours)')
+    args = parser.parse_args()
+
+    footage_dir = os.path.join(args.work_dir, 'footage')
+    ground_truth_file = os.path.join(footage_dir, 'ground_truth.yaml')
+    if args.regenerate or not os.path.exists(ground_truth_file):
+        logCoolMessage('Generating synthetic footage')
+        shutil.rmtree(footage_dir, ignore_errors=True)
+        generateFootage(footage_dir, datetime(2024, 6, 1), args.days, args.hours, args.clips_per_hour, args.seconds, args.seed)
+    ground_truth = parseYaml(ground_truth_file)
+
+    # Each run starts with empty caches so that all stages do all their work
+    run_dir = os.path.join(args.work_dir, 'run')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    cache = lambda name: os.path.join(run_dir, name)
+    profiles = [{'output': cache('slow_x140_fast_x4000.mp4'), 'slow': 140, 'fast': 4000, 'include_slow': True, 'include_fast': True}]
+    new_fps = 50
+    before_seconds, after_seconds = 1, 1
+
+    setupMetrics(progress=False)
+    setupAcceleration(args.writer)
+
+    rows = []
+    video_files = run_stage(rows, 'video search', None, handleVideoSearch, cache('videofiles.jsonl'), footage_dir, '.mp4', args.workers)
+    timestamp_dict = run_stage(rows, 'timetags', lambda result: sum(entry['total_frames'] for entry in result.values()),
+                               handleTimetags, video_files, cache('timestamps.jsonl'), args.workers, False, args.frame_skip, args.black_list,
+                               args.backend, cache('metadata.jsonl'), detector=args.detector)
+    timestamp_dict = run_stage(rows, 'intervals', None, handleIntervals, timestamp_dict, cache('timestamps.jsonl'), before_seconds, after_seconds)
+    frames_dicts = [run_stage(rows, 'frames', None, handleFrames, timestamp_dict, cache('frames.npz'), new_fps, profile['slow'], profile['fast'])
+                    for profile in profiles]
+    run_stage(rows, 'acceleration', lambda result: sum(len(frames[0]) for frames_dict in frames_dicts for frames in frames_dict.values()),
+              handleAcceleration, profiles, frames_dicts, new_fps, args.workers, cache('ffmpeg_video_list.txt'), cache('failed_videos.yaml'))
+
+    writeMetricsReport(cache('metrics_report.json'))
+
+    logCoolMessage('Pipeline benchmark')
+    log(f"{len(video_files)} videos, {args.backend} decoder, {args.detector} detector, {args.writer} writer, {args.workers} workers.", bcolors.OKCYAN)
+    log(f"{'stage':<14} {'seconds':>9} {'frames':>8} {'fps':>9} {'main MiB':>9} {'workers MiB':>12}", bcolors.OKCYAN)
+    for name, seconds, frames, main_rss, workers_rss in rows:
+        fps = f"{frames / seconds:>9.1f}" if frames and seconds > 0 else f"{'-':>9}"
+        log(f"{name:<14} {seconds:>9.2f} {frames if frames is not None else '-':>8} {fps} {main_rss:>9.1f} {workers_rss:>12.1f}")
+
+    # Videos matching the black list are not analysed, their ground truth is not checked
+    checked = {video: intervals for video, intervals in ground_truth.items() if not any(pattern in video for pattern in args.black_list)}
+    matched, total, false_timestamps = check_detection(timestamp_dict, checked, 2*args.frame_skip, def_warmup_seconds*def_fps)
+    matched_intervals, total_intervals, false_intervals = check_intervals(timestamp_dict, checked, before_seconds, after_seconds,
+                                                                          2*args.frame_skip, def_warmup_seconds*def_fps)
+    if matched == total and false_timestamps == 0 and matched_intervals == total_intervals and false_intervals == 0:
+        log(f"Detection matches ground truth: {matched}/{total} motion intervals found, no false detections, "
+            f"{matched_intervals}/{total_intervals} covered by merged intervals, no false intervals.", bcolors.OKGREEN)
+    else:
+        log(f"Detection does not match ground truth: {matched}/{total} motion intervals found, {false_timestamps} false detections, "
+            f"{matched_intervals}/{total_intervals} covered by merged intervals, {false_intervals} false intervals.", bcolors.ERROR)
+        sys.exit(1)
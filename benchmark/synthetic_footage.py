@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Generates synthetic nest footage with known motion for benchmarks. Clips follow the camera folder structure
+    (YYYYMM/DDd/HHh/MMmSSs_auto_300s_hd.mp4) with a static textured background, a bit of sensor noise and scripted
+    blobs moving inside the ROI of the clip date (see roi_table.yaml) at known frames. Same seed gives the same footage.
+    Ground truth is stored as a YAML dict of {video: [[first_frame, last_frame], ...]} with the frames where a blob
+    is moving, same format as the labels of benchmark/detector_benchmark.py.
+
+    Usage: python3 benchmark/synthetic_footage.py output_dir [--days N] [--hours 10 11] [--clips-per-hour N] [--seconds S] [--seed N]
+"""
+
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import find_timetags
+from utils.roi_utils import VideoRoi, findRoiEntry, parseRoiTable
+from utils.yaml_utils import dumpYaml
+from utils.log_utils import log, bcolors
+
+def_size = (1920, 1080)
+def_fps = 25
+def_noise_patterns = 8  # Noise frames are precomputed and cycled, generating noise for each frame is slow
+def_warmup_seconds = 3  # No motion at the start of the clips, background model of the detector converges meanwhile
+
+"""
+    Path of a clip starting at date, relative to the footage folder
+"""
+def clipPath(date):
+    return date.strftime('%Y%m/%dd/%Hh/%Mm%Ss_auto_300s_hd.mp4')
+
+"""
+    Static background: smooth gradient (walls, nest) with some texture, so that compression and background
+    subtraction behave as with real footage
+"""
+def make_background(size, rng):
+    width, height = size
+    x, y = np.meshgrid(np.linspace(0, 1, width, dtype=np.float32), np.linspace(0, 1, height, dtype=np.float32))
+    background = np.empty((height, width, 3), dtype=np.float32)
+    for channel, (base, gain) in enumerate(((70, 40), (80, 30), (90, 20))):
+        background[:, :, channel] = base + gain * x * y
+    texture = cv2.resize(rng.normal(0, 12, (height // 16, width // 16, 3)).astype(np.float32), size, interpolation=cv2.INTER_CUBIC)
+    return np.clip(background + texture, 0, 255).astype(np.uint8)
+
+"""
+    Scripted motion of one clip: list of blobs with first/last frame, start/end position (moving linearly between them),
+    radius and color. Blobs stay inside region (x, y, width, height)
+"""
+def script_blobs(total_frames, fps, region, rng, max_events = 2):
+    x, y, width, height = region
+    blobs = []
+    # Events do not overlap and start after the warm up
+    frame = int(def_warmup_seconds * fps)
+    for _ in range(rng.integers(0, max_events + 1)):
+        first = frame + int(rng.integers(1, 4) * fps)
+        last = first + int(rng.uniform(1.5, 4) * fps)
+        if last >= total_frames - fps:
+            break
+        radius = int(rng.integers(25, 60))
+        points = [(int(rng.integers(x + radius, x + width - radius)), int(rng.integers(y + radius, y + height - radius))) for _ in range(2)]
+        color = tuple(int(value) for value in rng.integers(0, 256, 3))
+        blobs.append({'first': first, 'last': last, 'start': points[0], 'end': points[1], 'radius': radius, 'color': color})
+        frame = last
+    return blobs
+
+"""
+    Writes a clip with the given blobs (see script_blobs), returns the ground truth intervals
+"""
+def generateClip(path, total_frames, blobs, rng, fps = def_fps, size = def_size, noise = 2.0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    background = make_background(size, rng)
+    noise_patterns = [rng.normal(0, noise, background.shape).astype(np.int16) for _ in range(def_noise_patterns)] if noise > 0 else []
+
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    frame = np.empty_like(background)
+    for index in range(total_frames):
+        if noise_patterns:
+            np.clip(background + noise_patterns[index % len(noise_patterns)], 0, 255, out=frame, casting='unsafe')
+        else:
+            np.copyto(frame, background)
+        for blob in blobs:
+            if blob['first'] <= index <= blob['last']:
+                progress = (index - blob['first']) / max(blob['last'] - blob['first'], 1)
+                center = tuple(int(round(start + (end - start) * progress)) for start, end in zip(blob['start'], blob['end']))
+                cv2.circle(frame, center, blob['radius'], blob['color'], -1)
+        out.write(frame)
+    out.release()
+    return [[blob['first'], blob['last']] for blob in blobs]
+
+"""
+    Generates footage in output_dir, clips_per_hour clips of seconds each for each day and hour starting at start_date.
+    Blobs are placed inside the ROI that applies to each clip date (roi_table). Returns {video: intervals} (ground truth)
+    and stores it in output_dir/ground_truth.yaml
+"""
+def generateFootage(output_dir, start_date, days = 1, hours = (0, 10, 11), clips_per_hour = 2, seconds = 20, seed = 0,
+                    fps = def_fps, size = def_size, roi_table = None, max_events = 2):
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    roi_table = find_timetags.def_roi_table if roi_table is None else roi_table
+
+    ground_truth = {}
+    for day in range(days):
+        for hour in hours:
+            for clip in range(clips_per_hour):
+                date = start_date.replace(hour=hour, minute=0, second=0) + timedelta(days=day, minutes=clip * 5)
+                video = os.path.join(output_dir, clipPath(date))
+                total_frames = int(seconds * fps)
+                region = VideoRoi(findRoiEntry(video, roi_table), size).crop
+                blobs = script_blobs(total_frames, fps, region, rng, max_events)
+                ground_truth[video] = generateClip(video, total_frames, blobs, rng, fps, size)
+                log(f"  Generated {video}: {len(blobs)} events.")
+
+    dumpYaml(os.path.join(output_dir, 'ground_truth.yaml'), ground_truth, 'w')
+    log(f"Generated {len(ground_truth)} clips in {output_dir}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).", bcolors.OKCYAN)
+    return ground_truth
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic nest footage generator')
+    parser.add_argument('output_dir')
+    parser.add_argument('--start-date', default='2024-06-01', help='Date of the first day (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--hours', type=int, nargs='+', default=[0, 10, 11])
+    parser.add_argument('--clips-per-hour', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--roi-table', default=None, help='ROI table YAML (default ROI table of find_timetags.py)')
+    args = parser.parse_args()
+
+    roi_table = parseRoiTable(args.roi_table) if args.roi_table else None
+    generateFootage(args.output_dir, datetime.fromisoformat(args.start_date), args.days, args.hours, args.clips_per_hour,
+                    args.seconds, args.seed, roi_table=roi_table)
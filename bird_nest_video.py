@@ -25,9 +25,13 @@ from utils.yaml_utils import parseYaml, dumpYaml
 from utils.ThreadVideoStream import ThreadVideoCapture, ThreadVideoWriter
 
 from find_videos import handleVideoSearch
-from find_timetags import handleTimetags
+from find_timetags import handleTimetags, setupRoiTable
+from utils.roi_utils import parseRoiTable
 from find_frames import handleIntervals, handleFrames
-from accelerate import handleAcceleration
+from accelerate import handleAcceleration, setupAcceleration
+from utils.metrics import setupMetrics, writeMetricsReport
+from stream_pipeline import handleStreamingPipeline
+from watch_folder import handleWatchFolder
 
 
 # Configuration of paths 
@@ -35,10 +39,14 @@ from accelerate import handleAcceleration
 input_video_path = './raw_videos/202405'
 input_video_extension = '.mp4'
 output_video_path = './processed_videos/'
+roi_table_file = './roi_table.yaml'  # Regions where motion is detected, with the dates in which each one applies (camera moves)
 
 
 # Night videos are ignored when extracting timetags. No movement :)
 timestamp_videos_black_list = ['/23h/','/00h/','/01h/','/02h/','/03h/','/04h/','/05h/','/06h/']
+# Night folders are not even scanned, their videos are left out of the outputs instead of being included at fast speed
+video_search_skip_black_list = False
+video_search_skip_patterns = timestamp_videos_black_list if video_search_skip_black_list else []
 
 # Max workers to use in multiprocessing
 # Acceleration takes less memory so it can actually use more CPU cores
@@ -49,6 +57,20 @@ max_workers_accelerate = os.cpu_count() - 1
 # Debug mask with window display showing results
 debug_mask = False
 
+# Live progress bars (tqdm) with the fps of decoding, detection and encoding
+progress_bar = True
+
+# Decoder used to extract timetags: 'opencv' or 'ffmpeg' (frames are cropped and scaled down by an ffmpeg subprocess)
+decode_backend = 'opencv'
+
+# Cheap frame differencing on a downsampled frame decides which frames go through background subtraction (see find_timetags.py).
+# Check benchmark/motion_gate_report.py with some of your videos before enabling it
+motion_gate = False
+
+# Motion detector: 'knn', 'mog2', 'framediff' or 'opticalflow' (see utils/motion_detectors.py and benchmark/detector_benchmark.py)
+motion_detector = 'knn'
+motion_detector_params = {}  # Empty to use the default parameters of the detector
+
 
 # Options to configure output
 frame_skip=8
@@ -58,25 +80,50 @@ timelapse_acceleration_factor=12000
 before_seconds=1
 after_seconds=1
 
+# Encoder of the output videos: 'opencv' (mp4v, big files) or 'ffmpeg' (encoded by an ffmpeg subprocess with encoder_settings).
+# Outputs can only be appended (watch mode) with segments of the same encoder
+writer_backend = 'opencv'
+encoder_settings = {'codec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'threads': 0, 'pix_fmt': 'yuv420p'}  # codec: libx264 or libx265
+filter_fast_path = True  # With 'ffmpeg' writer, clips with a single speed (nights, empty days) are rendered inside ffmpeg
 
 # Flags to activate/deactivate parts of SW
 video_search = True
+video_search_rescan = True  # Scan input folder even if there is a video list in cache (new footage is found)
 timestamp_search = True
 acceleartion = True
-concatenate = True
+concatenate = True  # Stitch accelerated segments into the final videos
+streaming = False   # Run all stages video by video (see stream_pipeline.py) instead of each stage for all videos
+watch = False       # Keep watching input folder and append new videos to the outputs as the camera writes them (see watch_folder.py)
+watch_interval = 60 # Seconds between scans of the input folder in watch mode
 
 
 # Filenames for cach files
-videofiles_cache_yaml = './cache/videofiles.chache.yaml' # File with all the videos that are to be included
-timestamps_cache_yaml = './cache/timestams.chache.yaml'  # Timestamp info about videos to be accelerated
-frames_cache_yaml = './cache/frames.chache.yaml'         # Specific frames to take once accelerated
-frames_timelapse_cache_yaml = './cache/frames_timelapse.chache.yaml'         # Specific frames to take once accelerated in timelapse
-ffmpeg_cache_file = './cache/ffmpeg_video_list.txt'      # Videos to be concatenated by ffmpeg
+# Cache files are stored as JSON Lines (see utils/cache_utils.py). Old .yaml caches with the same name are migrated on first use
+videofiles_cache_file = './cache/videofiles.chache.jsonl' # File with all the videos that are to be included
+video_metadata_cache_file = './cache/video_metadata.chache.jsonl' # FPS, frame count and size of each video (see utils/video_probe.py)
+timestamps_cache_file = './cache/timestams.chache.jsonl'  # Timestamp info about videos to be accelerated
+frames_cache_file = './cache/frames.chache.npz'           # Specific frames to take once accelerated (NumPy arrays)
+frames_timelapse_cache_file = './cache/frames_timelapse.chache.npz'           # Specific frames to take once accelerated in timelapse (NumPy arrays)
+ffmpeg_cache_file = './cache/ffmpeg_video_list.txt'      # Segments to be concatenated by ffmpeg
 failed_ffmpg_videos = './cache/error_videos.cache.yaml'  # Video list that is not correct and is excluded from ffmpeg concatenation
+watch_state_file = './cache/watch_state.chache.jsonl'    # Videos already appended to the outputs in watch mode
+metrics_report_file = './cache/metrics_report.json'       # Timers, fps, queue depths, cache hits and CPU per worker of last run (see utils/metrics.py)
 
 # Output FPS
 new_fps = 50
 
+# Output videos, all of them are rendered decoding each source video only once.
+#   output: path of the output video; slow/fast: acceleration factors for frames with/without movement
+#   include_slow/include_fast: add speed overlay to slow/fast frames; frames_cache_file: frames selected for this output
+output_profiles = [
+    {'output': f'{output_video_path}/slow_x{acceleration_factor_slow}_fast_x{acceleration_factor_fast}_complete_video.mp4',
+     'slow': acceleration_factor_slow, 'fast': acceleration_factor_fast, 'include_slow': True, 'include_fast': True,
+     'frames_cache_file': frames_cache_file},
+    {'output': f'{output_video_path}/fast_x{timelapse_acceleration_factor}_timelapse.mp4',
+     'slow': timelapse_acceleration_factor, 'fast': timelapse_acceleration_factor, 'include_slow': False, 'include_fast': True,
+     'frames_cache_file': frames_timelapse_cache_file},
+]
+
 
 
 if __name__ == "__main__":
@@ -84,6 +131,8 @@ if __name__ == "__main__":
     log(f'Flag {timestamp_search = }')
     log(f'Flag {acceleartion = }')
     log(f'Flag {concatenate = }')
+    log(f'Flag {streaming = }')
+    log(f'Flag {watch = }')
 
     if debug_mask:
         cv2.namedWindow("motion_mask", cv2.WINDOW_NORMAL) 
@@ -94,64 +143,53 @@ if __name__ == "__main__":
 
         max_workers=1
         max_workers_accelerate=1
-
-
-    ## CHECK FOR ALL VIDEO FILES AND GETS PATHS
-    if video_search:
-        video_files = handleVideoSearch(videofiles_cache_yaml, input_video_path, input_video_extension, max_workers)
+        streaming=False
+        watch=False
+
+    # Workers are created after this so they inherit the table
+    if os.path.exists(roi_table_file):
+        setupRoiTable(parseRoiTable(roi_table_file))
+    setupAcceleration(writer_backend, encoder_settings, filter_fast_path)
+    setupMetrics(progress_bar)
+
+
+    ## KEEPS WATCHING INPUT FOLDER, NEW VIDEOS ARE APPENDED TO THE OUTPUTS
+    if watch:
+        handleWatchFolder(input_video_path, input_video_extension, timestamps_cache_file, watch_state_file, timestamp_videos_black_list,
+                          output_profiles, new_fps, frame_skip, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                          decode_backend = decode_backend, interval = watch_interval, ffmpeg_cache_file = ffmpeg_cache_file,
+                          failed_videos_yaml = failed_ffmpg_videos, video_skip_patterns = video_search_skip_patterns,
+                          metadata_cache_file = video_metadata_cache_file, motion_gate = motion_gate,
+                          detector = motion_detector, detector_params = motion_detector_params, metrics_report_file = metrics_report_file)
+    ## RUNS ALL STAGES VIDEO BY VIDEO, RENDERING STARTS WHILE NEXT VIDEOS ARE BEING ANALYSED
+    elif streaming:
+        handleStreamingPipeline(input_video_path, input_video_extension, videofiles_cache_file, timestamps_cache_file, timestamp_videos_black_list,
+                                output_profiles, new_fps, frame_skip, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                                decode_backend = decode_backend, rescan = video_search_rescan, ffmpeg_cache_file = ffmpeg_cache_file, 
+                                failed_videos_yaml = failed_ffmpg_videos, concatenate = concatenate, video_skip_patterns = video_search_skip_patterns,
+                                metadata_cache_file = video_metadata_cache_file, motion_gate = motion_gate,
+                                detector = motion_detector, detector_params = motion_detector_params)
+    else:
+        ## CHECK FOR ALL VIDEO FILES AND GETS PATHS
+        if video_search:
+            video_files = handleVideoSearch(videofiles_cache_file, input_video_path, input_video_extension, max_workers, video_search_rescan, video_search_skip_patterns)
     
-    ## CHECKS ALL VIDEOS AND GETS TIMESTAMPS WITH MOVEMENT
-    if timestamp_search:
-        timestamp_dict = handleTimetags(video_files, timestamps_cache_yaml, max_workers, debug_mask, frame_skip, timestamp_videos_black_list)
-
-    ## ACCELERATES EACH VIDEO BASED ON COMPUTED TIMESTAMPS
-    if acceleartion:
-        logCoolMessage('Video acceleration')
-        timestamp_dict = handleIntervals(timestamp_dict, max_workers, timestamps_cache_yaml, before_seconds, after_seconds)
-        frames_dict = handleFrames(timestamp_dict, frames_cache_yaml, new_fps, acceleration_factor_slow, acceleration_factor_fast)
-        
-        output_video_name = f'{output_video_path}/slow_x{acceleration_factor_slow}_fast_x{acceleration_factor_fast}_complete_video.mp4'
-        handleAcceleration(frames_dict, output_video_name, new_fps, acceleration_factor_fast, acceleration_factor_slow)
-
-        output_video_name = f'{output_video_path}/fast_x{timelapse_acceleration_factor}_timelapse.mp4'
-        frames_dict_timelapse = handleFrames(timestamp_dict, frames_timelapse_cache_yaml, new_fps, timelapse_acceleration_factor, timelapse_acceleration_factor)
-        handleAcceleration(frames_dict_timelapse, output_video_name, new_fps, timelapse_acceleration_factor, timelapse_acceleration_factor, include_slow = False)
-
-    # ## CONCATENATE ALL RESULTING VIDEOS
-    # if concatenate:
-    #     output_video_name = f'{output_video_path}/slow{acceleration_factor_slow}_fast{acceleration_factor_fast}_complete_video.mp4'
-    #     logCoolMessage('Video concatenation')
-    #     video_list = sorted(search_videos((output_video_path, '_hd.mp4'), startswith=f'slow{acceleration_factor_slow}_fast{acceleration_factor_fast}_'))
+        ## CHECKS ALL VIDEOS AND GETS TIMESTAMPS WITH MOVEMENT
+        if timestamp_search:
+            timestamp_dict = handleTimetags(video_files, timestamps_cache_file, max_workers, debug_mask, frame_skip, timestamp_videos_black_list, decode_backend,
+                                            video_metadata_cache_file, motion_gate, motion_detector, motion_detector_params)
+
+        ## ACCELERATES EACH VIDEO BASED ON COMPUTED TIMESTAMPS
+        if acceleartion:
+            logCoolMessage('Video acceleration')
+            timestamp_dict = handleIntervals(timestamp_dict, timestamps_cache_file, before_seconds, after_seconds)
+            frames_dicts = [handleFrames(timestamp_dict, profile['frames_cache_file'], new_fps, profile['slow'], profile['fast']) for profile in output_profiles]
         
-    
-    #     # Check that videos are correct!
-    #     videos = []
-    #     failed = []
-    #     for video in video_list:
-    #         try:
-    #             mp.VideoFileClip(video)
-    #             videos.append(video)
-    #         except KeyError as e:
-    #             failed.append(video)
-    #             # log(f"KeyError::Exception for {video}, might be empty: {e}")
-    #         except OSError as e: 
-    #             failed.append(video)
-    #             if 'MoviePy error' in str(e):
-    #                 pass
-    #                 # log(f"Moviepy::Exception for {video}, might be empty: {e}")
-    #             else:
-    #                 log(f"OSError::Exception for {video}, might be empty: {e}")
-        
-    #     dumpYaml(failed_ffmpg_videos, failed)
+            handleAcceleration(output_profiles, frames_dicts, new_fps, max_workers = max_workers_accelerate, 
+                               ffmpeg_cache_file = ffmpeg_cache_file, failed_videos_yaml = failed_ffmpg_videos, concatenate = concatenate)
 
-    #     # Ejecutar el comando FFmpeg
-    #     # Escribir la lista de nombres de archivos de video en un archivo de texto
-    #     with open(ffmpeg_cache_file, 'w') as f:
-    #         for video in videos:
-    #             f.write(f"file '{video}'\n")
-    #     cmd_ffmpeg = ['ffmpeg', '-fflags', '+igndts', '-y', '-f', 'concat', '-safe', '0', '-i', f'{ffmpeg_cache_file}', '-c', 'copy', f'{output_video_name}']
-    #     subprocess.run(cmd_ffmpeg)
+    if not watch:
+        writeMetricsReport(metrics_report_file)
 
-    
     if debug_mask:
         cv2.destroyAllWindows()
\ No newline at end of file
@@ -6,71 +6,124 @@
 """
 
 import math
-from multiprocessing import Pool
+import numpy as np
 
 import time
 from datetime import timedelta
 
-from utils.yaml_utils import parseYaml, dumpYaml
+from utils.cache_utils import appendCache
+from utils.fingerprint_utils import paramsFingerprint
+from utils.array_utils import dumpFramesNpz
 from utils.log_utils import log
+from utils.metrics import def_metrics
+
+from find_timetags import encode_cache_entry
+
+# Speed of each selected frame
+SPEED_FAST = 0
+SPEED_SLOW = 1
+
+def_intervals_version = 2  # Increase when updateIntervals changes, so that cached intervals are computed again
 
 """
-    Computes time intervals for a given entry
+    Computes time intervals for a given entry. Each timestamp is extended before_seconds/after_seconds
+    and overlapping intervals are merged, all with array operations
 """
-def updateIntervals(args):
-    video_input, data_dict, before_seconds, after_seconds = args
-
-    intervals = []
-    timestamps = data_dict['timestamps']
-    if len(timestamps) > 1:
-        for timestamp in timestamps[1:]: # Ignore the 0 added when background detector started
-            start_interval = int(timestamp - before_seconds * data_dict['fps'])
-            end_interval = int(timestamp + after_seconds * data_dict['fps'])
-            intervals.append([start_interval, end_interval])
-
-        # Ordenar los intervalos por el punto de inicio
-        intervals.sort(key=lambda x: x[0])
-
-        # Merge overlapping intervals:
-        merged_intervals = [intervals[0]]
-        for interval in intervals[1:]:
-            if interval[0] <= merged_intervals[-1][1]:
-                merged_intervals[-1] = [merged_intervals[-1][0], max(interval[1], merged_intervals[-1][1])]
-            else:
-                merged_intervals.append(interval)
-    
+def updateIntervals(data_dict, before_seconds, after_seconds):
+    timestamps = np.sort(np.asarray(data_dict['timestamps'], dtype=np.int64))
+    # Ignore the 0 added when background detector started (KNN/MOG2 flag their first frame, other detectors do not)
+    if len(timestamps) > 0 and timestamps[0] == 0:
+        timestamps = timestamps[1:]
+
+    if len(timestamps) > 0:
+        # int() truncation as when computed one by one
+        starts = np.trunc(timestamps - before_seconds * data_dict['fps']).astype(np.int64)
+        ends = np.trunc(timestamps + after_seconds * data_dict['fps']).astype(np.int64)
+
+        # Merge overlapping intervals: a new one starts when its start is after all previous ends
+        running_end = np.maximum.accumulate(ends)
+        new_interval = np.concatenate(([True], starts[1:] > running_end[:-1]))
+        first = np.flatnonzero(new_interval)
+        last = np.concatenate((first[1:] - 1, [len(starts) - 1]))
+        merged_intervals = np.stack((starts[first], running_end[last]), axis=1).tolist()
     else:
         merged_intervals = [[math.inf, math.inf]]
 
     data_dict['merged_intervals'] = merged_intervals
-    result_dict = {video_input: data_dict}
+    return data_dict
+
+"""
+    Updates the intervals of an entry if they were computed with other parameters (or with new timestamps) and stores
+    them in the cache. Returns True if they were updated
+"""
+def checkIntervals(video, data_dict, timestamps_cache_file, before_seconds, after_seconds):
+    intervals_fingerprint = paramsFingerprint({'before_seconds': before_seconds, 'after_seconds': after_seconds, 'version': def_intervals_version})
+    if data_dict.get('intervals_fingerprint') == intervals_fingerprint:
+        return False
     
-    return result_dict
+    updateIntervals(data_dict, before_seconds, after_seconds)
+    data_dict['intervals_fingerprint'] = intervals_fingerprint
+    appendCache(timestamps_cache_file, video, encode_cache_entry(data_dict))
+    return True
 
 """
     Computes time interval based on movement detected timetags. Intervals are stored in the same data dict and file
 """
-def handleIntervals(timestamp_dict, max_workers, timestamps_cache_yaml, before_seconds, after_seconds):
+def handleIntervals(timestamp_dict, timestamps_cache_file, before_seconds, after_seconds):
 
     start = time.time()
-    with Pool(max_workers) as pool:
-        args_list = [(video, data_dict, before_seconds, after_seconds) for video, data_dict in timestamp_dict.items()]
-        results = pool.map(updateIntervals, args_list)
 
-        for result in results:
-            timestamp_dict.update(result)
+    # Only entries computed with other parameters (or with new timestamps) need to be updated
+    outdated = [video for video, data_dict in timestamp_dict.items() if checkIntervals(video, data_dict, timestamps_cache_file, before_seconds, after_seconds)]
+    def_metrics.count('intervals_cache_hit', len(timestamp_dict) - len(outdated))
+    def_metrics.count('intervals_cache_miss', len(outdated))
+    def_metrics.add('stage/intervals', time.time()-start)
     
-    dumpYaml(timestamps_cache_yaml, timestamp_dict, 'w')
-    
-    log(f"Handled frame intervals for {len(timestamp_dict.keys())} videos, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
+    log(f"Handled frame intervals for {len(timestamp_dict.keys())} videos ({len(outdated)} updated), took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
     return timestamp_dict
 
+"""
+    Selects the frames of a video whose frames are numbered from frame_offset in the general frame count. Frames
+    inside merged_intervals (slow) are taken each step_slow frames of the general count, the rest (fast) each step_fast.
+    Only candidate frames are generated and checked against the intervals with searchsorted.
+    Returns (frame_indices, speeds) sorted by frame index
+"""
+def selectVideoFrames(total_frames, merged_intervals, frame_offset, step_fast, step_slow):
+    intervals = np.asarray(merged_intervals, dtype=np.float64).reshape(-1, 2)
+    order = np.argsort(intervals[:, 0], kind='stable')
+    starts, ends = intervals[order, 0], intervals[order, 1]
+
+    def in_intervals(frames):
+        index = np.searchsorted(starts, frames, side='right') - 1
+        inside = index >= 0
+        inside[inside] = frames[inside] <= ends[index[inside]]
+        return inside
+
+    # Local frames whose general count is multiple of each step
+    fast = np.arange((-frame_offset) % step_fast, total_frames, step_fast, dtype=np.int64)
+    slow = np.arange((-frame_offset) % step_slow, total_frames, step_slow, dtype=np.int64)
+    fast = fast[~in_intervals(fast)]
+    slow = slow[in_intervals(slow)]
+
+    frame_indices = np.concatenate((fast, slow)).astype(np.int32)
+    speeds = np.concatenate((np.full(len(fast), SPEED_FAST, dtype=np.uint8), np.full(len(slow), SPEED_SLOW, dtype=np.uint8)))
+    order = np.argsort(frame_indices, kind='stable')
+    return frame_indices[order], speeds[order]
 
+"""
+    Frames selected for a timestamps entry whose first frame is frame_offset in the general frame count
+"""
+def selectEntryFrames(data_dict, frame_offset, new_fps, acceleration_factor_slow, acceleration_factor_fast):
+    fps = data_dict['fps']
+    step_fast = max(int(acceleration_factor_fast*fps/new_fps), 1)
+    step_slow = max(int(acceleration_factor_slow*fps/new_fps), 1)
+    return selectVideoFrames(data_dict['total_frames'], data_dict['merged_intervals'], frame_offset, step_fast, step_slow)
 
 """
-    Handles frames taking into account general frame count but adds local frame inedx for each video to be later concatenated
+    Handles frames taking into account general frame count but adds local frame inedx for each video to be later concatenated.
+    Returns {video: (frame_indices, speeds)} with int32 frame indexes and uint8 speeds (SPEED_FAST or SPEED_SLOW)
 """
-def handleFrames(timestamp_dict, frames_cache_yaml, new_fps, acceleration_factor_slow, acceleration_factor_fast):
+def handleFrames(timestamp_dict, frames_cache_file, new_fps, acceleration_factor_slow, acceleration_factor_fast):
     
     start = time.time()
 
@@ -78,38 +131,11 @@ def handleFrames(timestamp_dict, frames_cache_yaml, new_fps, acceleration_factor
     
     frame_count_general = 0
     for video, data_dict in timestamp_dict.items():
-        merged_intervals = data_dict['merged_intervals']
-        fps = data_dict['fps']
-
-        frames = []
-        
-        timestamp_index = 0
-        interval = merged_intervals[timestamp_index]
-        
-        for frame_count in range(data_dict['total_frames']):
-
-            in_interval = False
-            
-            if frame_count >= interval[0] and frame_count <= interval[1]:
-                in_interval = True
-            elif frame_count > interval[1]:
-                timestamp_index = min(timestamp_index+1, len(merged_intervals)-1)
-                interval = merged_intervals[timestamp_index]
-
-            if not in_interval:
-                # log(f"[{frame_count}] not in_interval")
-                if frame_count_general % int(acceleration_factor_fast*fps/new_fps) == 0:
-                    frames.append(['f', frame_count])
-
-            elif in_interval:
-                if frame_count_general % int(acceleration_factor_slow*fps/new_fps) == 0:
-                    frames.append(['s', frame_count])   
-            
-            frame_count_general+=1
-
-        frames_dict[video] = frames
-
-    dumpYaml(frames_cache_yaml, frames_dict, 'w')
+        frames_dict[video] = selectEntryFrames(data_dict, frame_count_general, new_fps, acceleration_factor_slow, acceleration_factor_fast)
+        frame_count_general += data_dict['total_frames']
+
+    dumpFramesNpz(frames_cache_file, frames_dict)
+    def_metrics.add('stage/frames', time.time()-start)
     
     log(f"Handled frames for {len(timestamp_dict.keys())} videos, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
-    return frames_dict
\ No newline at end of file
+    return frames_dict
@@ -6,8 +6,8 @@
 """
 
 import os
+from functools import partial
 from multiprocessing import Pool
-from more_itertools import chunked
 
 import time
 from datetime import timedelta
@@ -16,95 +16,220 @@ import cv2
 import numpy as np
 
 from utils.log_utils import logCoolMessage, log, bcolors
-from utils.yaml_utils import parseYaml, dumpYaml
+from utils.cache_utils import parseCache, appendCache, compactCache, cacheExists
+from utils.fingerprint_utils import fileFingerprint, paramsFingerprint
+from utils.array_utils import encodeRuns, decodeRuns
 from utils.ThreadVideoStream import ThreadVideoCapture, ThreadVideoWriter
+from utils.FFmpegVideoStream import FFmpegVideoCapture
+from utils.video_probe import probeVideo, handleVideoProbe
+from utils.motion_detectors import createDetector, MotionGate
+from utils.roi_utils import VideoRoi, findRoiEntry, checkRoiTable
+from utils.metrics import def_metrics, measured, progress, fpsPostfix
 
 def_debug_mask = False
 def_frame_skip = 5
+def_decode_backend = 'opencv' # 'opencv' or 'ffmpeg' (decodes, crops and scales in an ffmpeg subprocess)
+def_resize_factor = 0.6       # Reduce resolution to make background processing faster
+def_segment_warmup = 60       # Processed frames before the start of a video segment so that the background model converges
+def_threshold = 6             # Threshold for motion detector
+def_detector = 'knn'          # Motion detector, one of utils/motion_detectors.def_detectors: 'knn', 'mog2', 'framediff' or 'opticalflow'
+def_detector_params = {}      # Parameters of the detector (default ones if empty)
+def_cv_threads = 1            # OpenCV threads in each worker process, workers already use all cores
+
+# Cheap motion gate: frames only go through background subtraction and morphology when a heavily downsampled grayscale
+# version changed since the previous sampled frame. Most daytime frames are static and are discarded by the gate
+def_motion_gate = False
+def_gate_width = 64             # Width of the grayscale frame compared by the gate
+def_gate_pixel_threshold = 12   # Gray level difference for a pixel to be considered changed
+def_gate_min_pixels = 2         # Changed pixels needed to open the gate
+def_gate_hold = 10              # Sampled frames the gate is kept open after the last change
+def_gate_update_interval = 10   # Background model is still updated once every N frames discarded by the gate
+
+# Regions of interest to remove parts of image that has no motion (wall and ceil), usually loaded from roi_table.yaml
+# with setupRoiTable. See utils/roi_utils.py for the format of the entries, first entry that matches is used.
+def_roi_table = checkRoiTable([
+    {'to': '2024-05-18 17:52:04', 'margins': [680, 140, 550, 300]},
+    {'from': '2024-05-18 17:52:04', 'margins': [680, 240, 200, 130]}
+])
+
+"""
+    All parameters that affect the timestamps found for a video. Their fingerprint is stored with each
+    cache entry so that entries computed with different parameters are recomputed. Only the ROI entry used for
+    video is included, so changing the ROI table only updates the videos it affects
+"""
+def timetagParams(video = None):
+    # Default detector keeps the fingerprint of caches computed before detectors could be configured
+    detector = {'type': 'KNN', 'history': 300, 'kernel': 3, 'iterations': 4} if def_detector == 'knn' and not def_detector_params \
+               else {'type': def_detector, **def_detector_params}
+    params = {'frame_skip': def_frame_skip, 'threshold': def_threshold, 'resize_factor': def_resize_factor,
+              'decode_backend': def_decode_backend, 'detector': detector}
+    if video is not None:
+        params['roi'] = findRoiEntry(video, def_roi_table)
+    else:
+        params['roi_table'] = def_roi_table
+    # Only added when enabled so that caches computed without gate are still valid
+    if def_motion_gate:
+        params['gate'] = {'width': def_gate_width, 'pixel_threshold': def_gate_pixel_threshold, 'min_pixels': def_gate_min_pixels,
+                          'hold': def_gate_hold, 'update_interval': def_gate_update_interval}
+    return params
+
 """
     Scale speed of video based on detected movement in the image
     frame_skip: do not process all frames to go a bit faster
     threshold: threshold for motion detector
-    
+    segment_index, segment_count: process only one of segment_count consecutive parts of the video so that
+        a long video can be split between several workers (see merge_timestamps)
+    metadata: video metadata as returned by utils/video_probe.probeVideo, the video is probed if not provided
 """
-def process_video(input_path, threshold=6):
-    global def_frame_skip
+def process_video(input_path, threshold=def_threshold, segment_index=0, segment_count=1, metadata=None):
+    global def_frame_skip, def_segment_warmup
 
     start = time.time()
-    cap = ThreadVideoCapture(input_path, frameSkip=def_frame_skip)
-        
-    fps = cap.stream.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.stream.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    log(f"- Processing {input_path}: {round(fps)} FPS")
+    if metadata is None:
+        metadata = probeVideo(input_path)
+    fps = metadata['fps']
+    total_frames = metadata['total_frames']
+    frame_width = metadata['width']
+    frame_height = metadata['height']
     
-    segment_size = math.ceil(total_frames / os.cpu_count())  # Number of frames per segment
-    segment_size = total_frames
-    args = [(max(start_frame - 5, 0), min(start_frame + segment_size + 5, total_frames - 1), input_path, threshold, cap, input_path) for start_frame in range(0, total_frames, segment_size)]
+    segment_size = math.ceil(total_frames / segment_count)  # Number of frames per segment
+    start_frame = segment_index * segment_size
+    end_frame = min(start_frame + segment_size, total_frames)
+    # Segment starts processing some frames before so that the background model converges before storing timestamps
+    warmup_frame = max(start_frame - def_segment_warmup * def_frame_skip, 0)
     
+    segment_tag = f" (segment {segment_index+1}/{segment_count})" if segment_count > 1 else ""
+    log(f"- Processing {input_path}{segment_tag}: {round(fps)} FPS")
+
     timestamps = []
-    for arg in args:
-        timestamps.extend(process_segment_bgextractor(arg))
+    if start_frame < end_frame:
+        # Segments are only reached seeking by time when frame index and time map exactly
+        seek_fps = fps if metadata.get('constant_frame_rate') else None
+        timestamps = process_segment_bgextractor((warmup_frame, start_frame, end_frame, input_path, threshold, (frame_width, frame_height), seek_fps))
 
-    timestamp_dict = {input_path: {'timestamps':sorted(timestamps), 'fps':round(fps), 'total_frames':total_frames}}
+    timestamp_dict = {input_path: {'timestamps':np.array(sorted(timestamps), dtype=np.int32), 'fps':round(fps), 'total_frames':total_frames}}
     # log(f"Timestamps: {timestamp_dict}")
     
-    log(f"  Finished timestamp extraction for {input_path}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
+    def_metrics.video(input_path, 'timetags', time.time()-start, max(end_frame - start_frame, 0))
+    log(f"  Finished timestamp extraction for {input_path}{segment_tag}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
     return timestamp_dict
 
+"""
+    Wrapper to be used with Pool, args is (input_path, segment_index, segment_count[, metadata])
+"""
+def process_video_segment(args):
+    input_path, segment_index, segment_count, *metadata = args
+    return process_video(input_path, threshold=def_threshold, segment_index=segment_index, segment_count=segment_count,
+                         metadata=metadata[0] if metadata else None)
+
+"""
+    Merges the result of a video segment into timestamp_dict, timestamps found in several segments are only stored once
+"""
+def merge_timestamps(timestamp_dict, result):
+    for video, data_dict in result.items():
+        if video in timestamp_dict:
+            timestamps = np.union1d(timestamp_dict[video]['timestamps'], data_dict['timestamps'])
+            timestamp_dict[video]['timestamps'] = timestamps.astype(np.int32)
+        else:
+            timestamp_dict[video] = data_dict
+
+"""
+    Timestamps are stored in cache as runs of consecutive sampled frames, see utils/array_utils.encodeRuns
+"""
+def encode_cache_entry(data_dict):
+    entry = dict(data_dict)
+    entry['timestamps'] = {'runs': encodeRuns(data_dict['timestamps'], def_frame_skip), 'step': def_frame_skip}
+    return entry
+
+"""
+    Inverse of encode_cache_entry, timestamps are returned as an int32 array. Old entries with
+    the list of timestamps are also accepted
+"""
+def decode_cache_entry(entry):
+    data_dict = dict(entry)
+    timestamps = entry['timestamps']
+    if isinstance(timestamps, dict):
+        data_dict['timestamps'] = decodeRuns(timestamps['runs'], timestamps['step'])
+    else:
+        data_dict['timestamps'] = np.array(timestamps, dtype=np.int32)
+    return data_dict
+
+"""
+    Region of the image to be processed (see utils/roi_utils.VideoRoi), computed once for each video
+"""
+def get_roi(input_path, frame_size):
+    return VideoRoi(findRoiEntry(input_path, def_roi_table), frame_size, def_resize_factor)
+
+"""
+    Opens the capture for the configured decode backend, starting at start_frame. With 'ffmpeg' frames are already cropped
+    and scaled down when decoded and start_frame is reached seeking with the fps of the video. Both backends seek by time,
+    so start_frame > 0 is only exact with constant frame rate (see handleTimetags)
+"""
+def open_capture(input_path, frame_size, roi, start_frame = 0, fps = None):
+    global def_frame_skip, def_decode_backend
+
+    if def_decode_backend == 'ffmpeg':
+        return FFmpegVideoCapture(input_path, frame_size, crop=roi, scale=def_resize_factor, frameSkip=def_frame_skip, startFrame=start_frame, fps=fps)
+    
+    cap = ThreadVideoCapture(input_path, frameSkip=def_frame_skip)
+    if start_frame > 0:
+        cap.stream.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    return cap
 
 ## Version with backgroudn extraction
 def process_segment_bgextractor(args):
     global def_frame_skip
 
-    start_frame, end_frame, input_path, threshold, cap, input_path = args
+    warmup_frame, start_frame, end_frame, input_path, threshold, frame_size, fps = args
     timestamps = []
     
-    cap.stream.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-    frame_width = int(cap.stream.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    roi = get_roi(input_path, frame_size)
+    cap = open_capture(input_path, frame_size, roi.crop, warmup_frame, fps)
     cap.start() # Start frame aquisition once all set/get operations are done
 
     motion_detected = False
     
-    fgbg = cv2.createBackgroundSubtractorKNN(history=300, detectShadows=False)
-    # fgbg = cv2.createBackgroundSubtractorMOG2(history=300, varThreshold=16, detectShadows=False)
-    # kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3)) 
+    detector = createDetector(def_detector, threshold, def_detector_params)
+
+    gate = MotionGate(def_gate_width, def_gate_pixel_threshold, def_gate_min_pixels)
+    gate_hold = 0       # Frames left with the gate open
+    gate_discarded = 0  # Consecutive frames discarded by the gate
 
     # for frame_count in range(start_frame, end_frame + 1):
-    frame_count = 0
-    frame = cap.read()
-    while (frame is not None):
-
-        if input_path < './raw_videos/202405/18d/17h52m04s_auto_300s_hd.mp4':
-            # Just removes parts of image that has no motion (wall and ceil)
-            x0,y0 = 0,0
-            x1,y1 = 680,140
-            frame = frame[y1:frame_height-300, x1:frame_width-550]
-            roi_width, roi_height, _ = frame.shape
-        
-        else:
-            # Just removes parts of image that has no motion (wall and ceil)
-            x0,y0 = 0,0
-            x1,y1 = 680,240
-            frame = frame[y1:frame_height-130, x1:frame_width-200]
-            roi_width, roi_height, _ = frame.shape
+    read_start = time.perf_counter()
+    frame_count, frame = cap.readIndexed()
+    while (frame is not None and frame_count < end_frame):
+        # Waiting for frames means that decoding is slower than detection
+        detect_start = time.perf_counter()
+        def_metrics.add('timetags/decode_wait', detect_start - read_start)
 
-        # Reduce resolution to make background processing faster
-        frame = cv2.resize(frame, (0, 0), fx=0.6, fy=0.6, interpolation=cv2.INTER_AREA)
+        if def_decode_backend != 'ffmpeg':
+            # Crop and reduce resolution to make background processing faster
+            frame = roi.apply(frame)
+        else:
+            frame = roi.applyMask(frame)
 
-        motion_mask = fgbg.apply(frame)
-        # motion_mask = cv2.morphologyEx(motion_mask, cv2.MORPH_OPEN, kernel)   
-        motion_mask = cv2.erode(motion_mask,kernel,iterations=4)
-        motion_mask = cv2.dilate(motion_mask,kernel,iterations=4)
+        if def_motion_gate:
+            if gate.changed(frame):
+                gate_hold = def_gate_hold + 1
+            gate_hold = max(gate_hold - 1, 0)
 
-        motion = np.sum(motion_mask) > threshold
+        if not def_motion_gate or gate_hold > 0:
+            gate_discarded = 0
+            motion, motion_mask = detector.detect(frame)
+        else:
+            # Nothing changed, background model is only updated from time to time so that it follows slow changes (light)
+            gate_discarded += 1
+            if gate_discarded % def_gate_update_interval == 0:
+                detector.update(frame)
+            motion = False
 
         if motion > 0:
             # if not motion_detected:
             motion_detected = True
-            timestamps.append(frame_count)
+            # Frames from the warm up are only used to train the background model
+            if frame_count >= start_frame:
+                timestamps.append(frame_count)
             color = (0,255,0)
         else:
             motion_detected = False
@@ -126,62 +251,151 @@ def process_segment_bgextractor(args):
             if k == ord('q') or k == ord('Q') or k == 27:
                 return timestamps
             
-        frame = cap.read()
-        frame_count+=def_frame_skip
+        read_start = time.perf_counter()
+        def_metrics.add('timetags/detect', read_start - detect_start, 1)
+        frame_count, frame = cap.readIndexed()
         # print(f"{input_path}: {frame_count =}")
             
     cap.release()
     return timestamps
 
-def handleTimetags(video_files, timestamps_cache_yaml, max_workers, debug_mask, frame_skip, timestamp_videos_black_list = []):
-    global def_debug_mask, def_frame_skip
-    start = time.time()
+"""
+    Sets the configuration used to extract timestamps. Has to be called before creating worker processes
+"""
+def setupTimetags(debug_mask, frame_skip, decode_backend = 'opencv', motion_gate = False, detector = 'knn', detector_params = {}):
+    global def_debug_mask, def_frame_skip, def_decode_backend, def_motion_gate, def_detector, def_detector_params
 
     def_debug_mask = debug_mask 
     def_frame_skip = frame_skip
+    def_decode_backend = decode_backend
+    def_motion_gate = motion_gate
+    def_detector = detector
+    def_detector_params = detector_params
 
-    logCoolMessage('Extract timestamps from videofiles')
+"""
+    Initializer of worker processes, OpenCV threads of all workers would otherwise compete for the same cores
+"""
+def initTimetagsWorker():
+    cv2.setNumThreads(def_cv_threads)
+
+"""
+    Sets the ROI table (see utils/roi_utils.py), usually parsed from roi_table.yaml. Has to be called before creating worker processes
+"""
+def setupRoiTable(roi_table):
+    global def_roi_table
+    def_roi_table = checkRoiTable(roi_table)
+
+def loadTimestampsCache(timestamps_cache_file):
     timestamp_dict = {}
-    if os.path.exists(timestamps_cache_yaml):
-        log(f"File {timestamps_cache_yaml} already exists, parse data from it.")
-        timestamp_dict = parseYaml(timestamps_cache_yaml)
+    if cacheExists(timestamps_cache_file):
+        log(f"File {timestamps_cache_file} already exists, parse data from it.")
+        timestamp_dict = {video: decode_cache_entry(entry) for video, entry in parseCache(timestamps_cache_file).items()}
         log(f"A total of {len(timestamp_dict.keys())} timetagged videos parsed.", bcolors.OKCYAN)
+    return timestamp_dict
+
+"""
+    Checks the cache entry of a video. Entries are only valid if neither the video file nor the parameters changed.
+    Blacklisted videos are filled without processing them (metadata taken from metadata_dict if available). Returns True
+    if the entry in timestamp_dict is ready to be used and False if timestamps have to be computed (outdated entry is removed)
+"""
+def checkCachedEntry(timestamp_dict, file, timestamp_videos_black_list, timestamps_cache_file, metadata_dict = None):
+    file_fingerprint = fileFingerprint(file)
+    black_listed = any(pattern in file for pattern in timestamp_videos_black_list)
+    expected_fingerprint = paramsFingerprint({'black_list': True}) if black_listed else paramsFingerprint(timetagParams(file))
 
+    data_dict = timestamp_dict.get(file)
+    if data_dict is not None:
+        # Entries from caches without fingerprint were computed by the old ThreadVideoCapture, that only analysed the
+        # beginning of each video, so they are recomputed. Blacklisted ones ([0], no processing involved) are still valid
+        if 'file_fingerprint' not in data_dict:
+            legacy_black_listed = black_listed and np.array_equal(data_dict['timestamps'], [0])
+            data_dict.update({'file_fingerprint': file_fingerprint, 'params_fingerprint': expected_fingerprint if legacy_black_listed else 'legacy'})
+            if legacy_black_listed:
+                appendCache(timestamps_cache_file, file, encode_cache_entry(data_dict))
+        if data_dict['file_fingerprint'] == file_fingerprint and data_dict['params_fingerprint'] == expected_fingerprint:
+            return True
+    
     # Ignored blacklist and set to be accelerated at full speed :)
-    for file in video_files:
-        ignore = False
-        for pattern in timestamp_videos_black_list:
-            if pattern in file and file not in list(timestamp_dict.keys()):
-                stream = cv2.VideoCapture(file)
-                fps = stream.get(cv2.CAP_PROP_FPS)
-                total_frames = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
-                stream.release()
-                timestamp_dict[file] = {'timestamps': [0], 'fps': round(fps), 'total_frames': total_frames}
-
-    # Recompute those that are missing
-    video_files = [i for i in video_files if i not in timestamp_dict.keys()]
+    if black_listed:
+        metadata = metadata_dict[file] if metadata_dict is not None and file in metadata_dict else probeVideo(file)
+        timestamp_dict[file] = {'timestamps': np.zeros(1, dtype=np.int32), 'fps': round(metadata['fps']), 'total_frames': metadata['total_frames'],
+                                'file_fingerprint': file_fingerprint, 'params_fingerprint': expected_fingerprint}
+        appendCache(timestamps_cache_file, file, encode_cache_entry(timestamp_dict[file]))
+        return True
+    
+    timestamp_dict.pop(file, None)
+    return False
+
+"""
+    Stores a computed entry with its fingerprints in the cache
+"""
+def saveTimestampsEntry(timestamp_dict, video, timestamps_cache_file):
+    timestamp_dict[video].update({'file_fingerprint': fileFingerprint(video), 'params_fingerprint': paramsFingerprint(timetagParams(video))})
+    appendCache(timestamps_cache_file, video, encode_cache_entry(timestamp_dict[video]))
+
+"""
+    Computes timestamps of all video_files that are not in cache. Video metadata is taken from metadata_cache_file
+    (see utils/video_probe.py) if provided, otherwise each video is probed when needed
+"""
+def handleTimetags(video_files, timestamps_cache_file, max_workers, debug_mask, frame_skip, timestamp_videos_black_list = [], decode_backend = 'opencv', metadata_cache_file = None,
+                   motion_gate = False, detector = 'knn', detector_params = {}):
+    start = time.time()
+
+    setupTimetags(debug_mask, frame_skip, decode_backend, motion_gate, detector, detector_params)
+
+    logCoolMessage('Extract timestamps from videofiles')
+    timestamp_dict = loadTimestampsCache(timestamps_cache_file)
+    metadata_dict = handleVideoProbe(video_files, metadata_cache_file, max_workers) if metadata_cache_file is not None else {}
+
+    requested_videos = set(video_files)
+    pending_videos = [file for file in video_files if not checkCachedEntry(timestamp_dict, file, timestamp_videos_black_list, timestamps_cache_file, metadata_dict)]
+    def_metrics.count('timestamps_cache_hit', len(requested_videos) - len(pending_videos))
+    def_metrics.count('timestamps_cache_miss', len(pending_videos))
+
+    # Recompute those that are missing or outdated
+    video_files = pending_videos
     
     log(f"Timestamps from {len(video_files)} videos that need update.", bcolors.OKCYAN)#: {[file.split('/')[-4:] for file in video_files]}")
     
-    ## Ensure it stores computed data from time to time to avoid...issues...
-    slice_size = max_workers*5 if max_workers*5 < len(video_files) else len(video_files)
+    # Longest videos first so that the short ones fill the gaps at the end
+    video_files = sorted(video_files, key=lambda video: os.path.getsize(video), reverse=True)
+    # With less videos than workers, each video is split in segments to keep all of them busy. Segments are reached
+    # seeking by time (both backends), which only lands on the right frame in videos with constant frame rate
+    segment_count = math.ceil(max_workers / len(video_files)) if 0 < len(video_files) < max_workers else 1
+    video_segments = {video: segment_count if segment_count > 1 and (metadata_dict.get(video) or probeVideo(video))['constant_frame_rate'] else 1
+                      for video in video_files}
     processed = 0
     if def_debug_mask:
         for video in video_files:
-            result = process_video(video)
+            result = process_video(video, metadata=metadata_dict.get(video))
             timestamp_dict.update(result)
+            saveTimestampsEntry(timestamp_dict, video, timestamps_cache_file)
     else:
-        for video_slice in chunked(video_files, slice_size):
-            with Pool(max_workers) as pool:
-                results = pool.map(process_video, video_slice)
-
-                for result in results:
-                    timestamp_dict.update(result)
+        args_list = [(video, segment_index, video_segments[video], metadata_dict.get(video)) for video in video_files for segment_index in range(video_segments[video])]
+        pending_segments = dict(video_segments)
+        # A single pool for all videos, each worker takes the next segment as soon as it finishes the previous one
+        with Pool(max_workers, initializer=initTimetagsWorker) as pool, progress(total=len(args_list), desc='Timetags', unit='segment') as bar:
+            for result, snapshot in pool.imap_unordered(partial(measured, process_video_segment), args_list, chunksize=1):
+                def_metrics.merge(snapshot)
+                bar.update()
+                bar.set_postfix(fpsPostfix(('capture/decode', 'timetags/detect')))
+                merge_timestamps(timestamp_dict, result)
 
-            # pbar.update(slice_size)
-            processed += slice_size
-            log(f"Partial save: processed {processed}/{len(video_files)} videos.", bcolors.OKCYAN)
-            dumpYaml(timestamps_cache_yaml, timestamp_dict, 'w')
+                ## Ensure it stores computed data from time to time to avoid...issues...
+                for video in result.keys():
+                    pending_segments[video] -= 1
+                    if pending_segments[video] == 0:
+                        processed += 1
+                        log(f"Saved {video}: processed {processed}/{len(video_files)} videos.", bcolors.OKCYAN)
+                        saveTimestampsEntry(timestamp_dict, video, timestamps_cache_file)
     
+    # Drop records that were overwritten while appending
+    compactCache(timestamps_cache_file)
+
+    # Videos finish in any order, keep them sorted by path (chronological order) as when parsed from cache.
+    # Cache entries of videos that are not requested are kept in the cache but not returned
+    timestamp_dict = {video: timestamp_dict[video] for video in sorted(requested_videos) if video in timestamp_dict}
+
+    def_metrics.add('stage/timetags', time.time()-start)
     log(f"Handled timetags for {len(timestamp_dict.keys())} videos, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
     return timestamp_dict
\ No newline at end of file
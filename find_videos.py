@@ -6,49 +6,78 @@
 """
 
 import os
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import time
 
 from utils.log_utils import logCoolMessage, log, bcolors
-from utils.yaml_utils import parseYaml, dumpYaml
+from utils.cache_utils import parseCache, dumpCache, cacheExists
+from utils.metrics import def_metrics
 
-# First find all videos to be processed
-def search_videos(args, startswith = ''):
-    root, extension = args
+"""
+    Lists a single directory, returns (subdirectories, video_files). Entry types come from the directory listing
+    itself (os.scandir) so no extra stat call is made for each file. Paths containing any of skip_patterns
+    (like '/23h/') are not returned, so their folders are never listed
+"""
+def scan_directory(directory, extension, skip_patterns = []):
+    subdirectories = []
     video_files = []
-    for root, dirs, files in os.walk(root):
-        for file in files:
-            if file.endswith(extension) and file.startswith(startswith):
-                video_files.append(os.path.join(root, file))
-    return video_files
-
-def find_videos(directory, extension, max_workers):
-    
-    subdirectories = [os.path.join(directory, d) for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
-    args = [(subdir, extension) for subdir in subdirectories]
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not any(pattern in f'{entry.path}/' for pattern in skip_patterns):
+                        subdirectories.append(entry.path)
+                elif entry.name.endswith(extension) and not any(pattern in entry.path for pattern in skip_patterns):
+                    video_files.append(entry.path)
+    except OSError as e:
+        log(f"Could not list {directory}: {e}", bcolors.WARNING)
+    return subdirectories, video_files
 
+"""
+    Finds all videos under directory. Listing is I/O bound (specially on network mounts) so each directory is scanned
+    in a thread as soon as its parent is listed. Returns the sorted list of paths (chronological order for the
+    camera folder structure)
+"""
+def find_videos(directory, extension, max_workers, skip_patterns = []):
     video_files = []
-    with Pool(max_workers) as pool:
-        video_files = pool.map(search_videos, args)
-        # for result in tqdm.tqdm(pool.imap_unordered(search_videos, args), total=len(args)):
-        #     video_files.append(result)
-          
-    
-    # Flatten the list of lists returned by pool.map
-    video_files = [file for sublist in video_files for file in sublist]
-    
-    return video_files
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = {executor.submit(scan_directory, directory, extension, skip_patterns)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirectories, files = future.result()
+                video_files.extend(files)
+                pending.update(executor.submit(scan_directory, subdirectory, extension, skip_patterns) for subdirectory in subdirectories)
+
+    return sorted(video_files)
 
 
-def handleVideoSearch(videofiles_cache_yaml, input_video_path, input_video_extension, max_workers):
+"""
+    Searchs for all video files. The folder is scanned again (unless rescan is False) so that new footage is found,
+    per video results of later stages are kept in their own caches, so only the new videos are processed.
+    Folders matching skip_patterns are not scanned, so their videos are not included in the outputs at all
+"""
+def handleVideoSearch(videofiles_cache_file, input_video_path, input_video_extension, max_workers, rescan = True, skip_patterns = []):
+    start = time.time()
     logCoolMessage('Search for all video files')
     video_files = []
-    if os.path.exists(videofiles_cache_yaml):
-        log(f"File {videofiles_cache_yaml} already exists, parse data from it.")
-        video_files = parseYaml(videofiles_cache_yaml)
-    else:
+    cached_video_files = []
+    if cacheExists(videofiles_cache_file):
+        log(f"File {videofiles_cache_file} already exists, parse data from it.")
+        cached_video_files = parseCache(videofiles_cache_file)
+    
+    if rescan or not cached_video_files:
         log(f"Search video files in  {input_video_path}.")
-        video_files = find_videos(input_video_path, input_video_extension, max_workers)
-        dumpYaml(videofiles_cache_yaml, video_files, 'w')
+        video_files = find_videos(input_video_path, input_video_extension, max_workers, skip_patterns)
+        new_files = set(video_files) - set(cached_video_files)
+        removed_files = set(cached_video_files) - set(video_files)
+        log(f"Found {len(new_files)} new video files, {len(removed_files)} video files no longer available.", bcolors.OKCYAN)
+        if new_files or removed_files:
+            dumpCache(videofiles_cache_file, video_files, 'w')
+    else:
+        video_files = cached_video_files
+    def_metrics.add('stage/video_search', time.time()-start)
     log(f"A total of {len(video_files)} video files found.", bcolors.OKCYAN)
 
     return video_files
\ No newline at end of file
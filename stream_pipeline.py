@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Streaming version of the whole pipeline. Each video goes through timetag detection, interval merging, frame
+    selection and rendering as soon as the previous videos are done, so rendering of the first videos starts while
+    the following ones are still being analysed. Results are the same as running each stage for all videos.
+"""
+
+import os
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+
+import time
+from datetime import timedelta
+
+from utils.log_utils import log, bcolors, logCoolMessage
+from utils.yaml_utils import dumpYaml
+from utils.cache_utils import compactCache
+from utils.array_utils import dumpFramesNpz
+from utils.video_probe import handleVideoProbe
+from utils.metrics import def_metrics, measured, progress, fpsPostfix
+
+from find_videos import handleVideoSearch
+from find_timetags import setupTimetags, loadTimestampsCache, checkCachedEntry, saveTimestampsEntry, process_video_segment, initTimetagsWorker
+from find_frames import checkIntervals, selectEntryFrames
+from accelerate import segment_path, segmentArgs, accelerate_segment, concatenate_segments
+
+"""
+    Yields (video, data_dict) in the order of video_files. Videos without valid cache entry are processed in pool,
+    at most max_pending videos are queued ahead of the one being yielded
+"""
+def stream_timetags(video_files, timestamp_dict, pool, timestamp_videos_black_list, timestamps_cache_file, max_pending, metadata_dict = {}):
+    def finish(video, result):
+        if result is not None:
+            result, snapshot = result.get()
+            def_metrics.merge(snapshot)
+            timestamp_dict.update(result)
+            saveTimestampsEntry(timestamp_dict, video, timestamps_cache_file)
+        return video, timestamp_dict[video]
+
+    pending = deque()
+    for video in video_files:
+        if checkCachedEntry(timestamp_dict, video, timestamp_videos_black_list, timestamps_cache_file, metadata_dict):
+            def_metrics.count('timestamps_cache_hit')
+            pending.append((video, None))
+        else:
+            def_metrics.count('timestamps_cache_miss')
+            pending.append((video, pool.apply_async(partial(measured, process_video_segment), ((video, 0, 1, metadata_dict.get(video)),))))
+
+        # Yields all videos that are already done, waits for the oldest one if too many are queued
+        while pending and (len(pending) > max_pending or pending[0][1] is None or pending[0][1].ready()):
+            yield finish(*pending.popleft())
+
+    while pending:
+        yield finish(*pending.popleft())
+
+"""
+    Streams video_files (in chronological order) through detection, intervals, frame selection and rendering.
+    frame_count_general is the general frame count of the first video (frames of previous videos).
+    Returns (segment_lists, frames_dicts, failed, frame_count_general) with the segments of each profile output,
+    the frames selected for each profile, videos that could not be rendered and the general count after the last video
+"""
+def streamVideos(video_files, timestamp_dict, profiles, new_fps, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                 timestamp_videos_black_list, timestamps_cache_file, frame_count_general = 0, metadata_dict = {}):
+    for profile in profiles:
+        os.makedirs(os.path.dirname(segment_path(profile['output'], '')), exist_ok=True)
+
+    frames_dicts = [{} for _ in profiles]
+    segment_lists = {profile['output']: [] for profile in profiles}
+    failed = []
+
+    def collect(args, result):
+        video, profile_frames, _ = args
+        segments, snapshot = result.get()
+        def_metrics.merge(snapshot)
+        for (_, _, profile), segment in zip(profile_frames, segments):
+            if segment is None:
+                failed.append(video)
+            else:
+                segment_lists[profile['output']].append(segment)
+
+    rendering = deque()
+    # Bounded queues between stages keep memory flat: detection waits for rendering and the other way around
+    with Pool(max_workers, initializer=initTimetagsWorker) as detect_pool, Pool(max_workers_accelerate) as render_pool, \
+         progress(total=len(video_files), desc='Streaming') as bar:
+        for video, data_dict in stream_timetags(video_files, timestamp_dict, detect_pool, timestamp_videos_black_list, timestamps_cache_file, max_workers*2, metadata_dict):
+            checkIntervals(video, data_dict, timestamps_cache_file, before_seconds, after_seconds)
+
+            frames_list = [selectEntryFrames(data_dict, frame_count_general, new_fps, profile['slow'], profile['fast']) for profile in profiles]
+            frame_count_general += data_dict['total_frames']
+            for frames_dict, frames in zip(frames_dicts, frames_list):
+                frames_dict[video] = frames
+
+            args = segmentArgs(video, profiles, frames_list, new_fps)
+            if args is not None:
+                rendering.append((args, render_pool.apply_async(partial(measured, accelerate_segment), (args,))))
+
+            # Segments are collected in order
+            while rendering and (len(rendering) > max_workers_accelerate*2 or rendering[0][1].ready()):
+                collect(*rendering.popleft())
+            log(f"Streamed {video}, {len(rendering)} segments being rendered.")
+            bar.update()
+            bar.set_postfix(fpsPostfix(('capture/decode', 'timetags/detect', 'render/decode', 'writer/encode')))
+
+        while rendering:
+            collect(*rendering.popleft())
+
+    return segment_lists, frames_dicts, sorted(set(failed)), frame_count_general
+
+def handleStreamingPipeline(input_video_path, input_video_extension, videofiles_cache_file, timestamps_cache_file, timestamp_videos_black_list,
+                            profiles, new_fps, frame_skip, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                            decode_backend = 'opencv', rescan = True, ffmpeg_cache_file = './cache/ffmpeg_video_list.txt', failed_videos_yaml = None, concatenate = True, video_skip_patterns = [],
+                            metadata_cache_file = None, motion_gate = False,
+                            detector = 'knn', detector_params = {}):
+    start = time.time()
+
+    video_files = sorted(handleVideoSearch(videofiles_cache_file, input_video_path, input_video_extension, max_workers, rescan, skip_patterns=video_skip_patterns))
+
+    logCoolMessage('Streaming timetags, frames and acceleration')
+    setupTimetags(False, frame_skip, decode_backend, motion_gate, detector, detector_params)
+    timestamp_dict = loadTimestampsCache(timestamps_cache_file)
+    metadata_dict = handleVideoProbe(video_files, metadata_cache_file, max_workers) if metadata_cache_file is not None else {}
+
+    segment_lists, frames_dicts, failed, _ = streamVideos(video_files, timestamp_dict, profiles, new_fps, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                                                          timestamp_videos_black_list, timestamps_cache_file, metadata_dict = metadata_dict)
+
+    compactCache(timestamps_cache_file)
+    for profile, frames_dict in zip(profiles, frames_dicts):
+        if 'frames_cache_file' in profile:
+            dumpFramesNpz(profile['frames_cache_file'], frames_dict)
+
+    if failed:
+        log(f"Could not accelerate {len(failed)} videos.", bcolors.WARNING)
+    if failed_videos_yaml is not None:
+        dumpYaml(failed_videos_yaml, failed, 'w')
+
+    if concatenate:
+        for output_video_name, segment_list in segment_lists.items():
+            if segment_list:
+                concatenate_segments(segment_list, output_video_name, ffmpeg_cache_file)
+
+    def_metrics.add('stage/streaming', time.time()-start)
+    log(f"Streamed {len(video_files)} videos into {', '.join(segment_lists.keys())}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
+    return segment_lists
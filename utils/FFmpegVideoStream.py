@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Video streams backed by an ffmpeg subprocess. Frames are exchanged as raw BGR data through a pipe, so
+    filtering (frame skip, crop, scale) is done by ffmpeg while decoding and encoding runs in its own process
+    with the codec and quality settings of ffmpeg
+"""
+
+import math
+import subprocess
+
+import time
+
+import numpy as np
+
+from utils.log_utils import log, bcolors
+from utils.metrics import def_metrics
+from utils.ThreadVideoStream import ThreadVideoBase, ThreadVideoWriter
+
+# Default encoder settings of FFmpegVideoWriter, threads = 0 lets ffmpeg choose
+def_encoder = {'codec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'threads': 0, 'pix_fmt': 'yuv420p'}
+
+"""
+    Streams already cropped and scaled down frames from ffmpeg. Exposes the same read interface as ThreadVideoCapture.
+    size: (width, height) of the source video
+    crop: (x, y, width, height) region of the source video to keep, None to keep all of it
+    scale: scale factor applied to the cropped region
+    frameSkip: only one of each frameSkip frames is sent through the pipe
+    startFrame: first frame to be sent. With fps, ffmpeg seeks to it (decoding from the previous keyframe), without it
+                frames before it are decoded but not filtered nor sent
+    fps: frame rate of the source video, used to get the seek position of startFrame
+    buffers: number of reusable buffers, a frame returned by read() is valid until buffers-1 more frames are read
+"""
+class FFmpegVideoCapture:
+    def __init__(self, path, size, crop = None, scale = 1.0, frameSkip = 1, startFrame = 0, buffers = 2, fps = None):
+        self.video_path = path
+        self.frameSkip = frameSkip
+        # Same frames as ThreadVideoCapture, those with an index multiple of frameSkip
+        self.first_frame = math.ceil(startFrame / frameSkip) * frameSkip
+        self.process = None
+
+        frame_width, frame_height = size
+        x, y, crop_width, crop_height = crop if crop is not None else (0, 0, frame_width, frame_height)
+        # Same rounding as cv2.resize with fx/fy
+        self.width = int(round(crop_width * scale))
+        self.height = int(round(crop_height * scale))
+
+        # Input seek is accurate, frames before the position are decoded from the previous keyframe and dropped. Half a frame
+        # before first_frame so that rounding of timestamps does not skip it. Frame numbers (n) start again from first_frame,
+        # which is a multiple of frameSkip, so that the same frames are selected
+        seek = self.first_frame > 0 and fps is not None and fps > 0
+        filters = []
+        if self.first_frame > 0 and not seek:
+            filters.append(f"select='gte(n\\,{self.first_frame})*not(mod(n\\,{frameSkip}))'")
+        elif frameSkip > 1:
+            filters.append(f"select='not(mod(n\\,{frameSkip}))'")
+        if crop is not None:
+            filters.append(f"crop={crop_width}:{crop_height}:{x}:{y}")
+        if scale != 1.0:
+            filters.append(f"scale={self.width}:{self.height}:flags=area")
+
+        self.cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+        if seek:
+            self.cmd += ['-ss', f'{(self.first_frame - 0.5) / fps:.6f}']
+        self.cmd += ['-i', path]
+        if filters:
+            self.cmd += ['-vf', ','.join(filters)]
+        # -vsync 0 avoids frames being duplicated/dropped to match a constant frame rate
+        self.cmd += ['-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+
+        # Frames are read into preallocated buffers, no allocation per frame
+        self.buffers = [np.empty((self.height, self.width, 3), dtype=np.uint8) for _ in range(max(buffers, 1))]
+        self.frame_count = 0
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, bufsize=self.buffers[0].nbytes)
+        except FileNotFoundError:
+            log(f"Error opening video {self.video_path}: ffmpeg executable not found", bcolors.ERROR)
+        return self
+
+    def more(self):
+        return self.process is not None and self.process.poll() is None
+
+    def readIndexed(self):
+        # return next (frame_index, frame) from the pipe, (None, None) when the stream is finished.
+        # frame_index is the real position of the frame in the video file
+        if self.process is None:
+            return None, None
+
+        start = time.perf_counter()
+        buffer = self.buffers[self.frame_count % len(self.buffers)]
+        view = memoryview(buffer).cast('B')
+        read = 0
+        while read < len(view):
+            chunk = self.process.stdout.readinto(view[read:])
+            if not chunk:
+                return None, None
+            read += chunk
+
+        frame_index = self.first_frame + self.frame_count * self.frameSkip
+        self.frame_count += 1
+        def_metrics.add('capture/decode', time.perf_counter() - start, 1)
+        return frame_index, buffer
+
+    def read(self):
+        return self.readIndexed()[1]
+
+    def release(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
+
+"""
+    Output arguments of ffmpeg for the encoder settings, missing keys take def_encoder values
+"""
+def encoderArgs(encoder = {}):
+    encoder = {**def_encoder, **encoder}
+    args = ['-c:v', encoder['codec'], '-preset', str(encoder['preset']), '-crf', str(encoder['crf']),
+            '-threads', str(encoder['threads']), '-pix_fmt', encoder['pix_fmt']]
+    # Players (QuickTime, browsers) only recognize HEVC in mp4 with this tag
+    if encoder['codec'] == 'libx265':
+        args += ['-tag:v', 'hvc1', '-x265-params', 'log-level=error']
+    return args
+
+"""
+    ffmpeg process that encodes the raw BGR frames written to its stdin. Same write/release interface as cv2.VideoWriter,
+    release() also returns whether the video was fully encoded (ffmpeg could be started, did not stop and exited with 0).
+    size: (width, height) of the frames
+    encoder: dict with codec (libx264, libx265...), preset, crf, threads and pix_fmt, missing keys take def_encoder values
+"""
+class FFmpegEncoder:
+    def __init__(self, path, fps, size, encoder = {}):
+        self.video_path = path
+        self.process = None
+        frame_width, frame_height = size
+
+        self.cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{frame_width}x{frame_height}', '-framerate', str(fps), '-i', '-']
+        self.cmd += encoderArgs(encoder) + [path]
+
+        try:
+            self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            log(f"Error opening video {path}: ffmpeg executable not found", bcolors.ERROR)
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+        except BrokenPipeError:
+            log(f"Error writing {self.video_path}: ffmpeg exited with code {self.process.wait()}", bcolors.ERROR)
+            self.process.stdin.close()
+            self.process = None
+
+    def release(self):
+        # Not started or stopped while writing, errors are already logged
+        if self.process is None:
+            return False
+        # Closing stdin ends the input, ffmpeg flushes the encoder and finishes the file
+        self.process.stdin.close()
+        encoded = self.process.wait() == 0
+        if not encoded:
+            log(f"Error encoding {self.video_path}: ffmpeg exited with code {self.process.returncode}", bcolors.ERROR)
+        self.process = None
+        return encoded
+
+"""
+    ThreadVideoWriter that encodes with ffmpeg (see FFmpegEncoder) instead of cv2.VideoWriter. Same start/write/release
+    interface, frames are sent to the ffmpeg pipe from the writer thread
+"""
+class FFmpegVideoWriter(ThreadVideoWriter):
+    def __init__(self, path, fps, size, encoder = {}, queueSize=100):
+        ThreadVideoBase.__init__(self, path, queueSize)
+
+        self.stream = FFmpegEncoder(path, fps, size, encoder)
+
+"""
+    Encodes count frames of the video, one of each step frames starting at first_frame, without sending them through
+    Python: selection, timestamps and overlay are an ffmpeg filter graph. Output has the same encoder settings and frame
+    rate as FFmpegVideoWriter, so both can be concatenated with stream copy.
+    overlay: (image_path, x, y) image with alpha drawn on all frames, None for no overlay
+    Returns True if the video was written
+"""
+def encodeSelectedFrames(path, output_path, first_frame, step, count, fps, encoder = {}, overlay = None):
+    filters = f"[0:v]select='gte(n\\,{first_frame})*not(mod(n-{first_frame}\\,{step}))',setpts=N/({fps}*TB)"
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', path]
+    if overlay is not None:
+        image_path, x, y = overlay
+        cmd += ['-i', image_path]
+        filters += f"[selected];[selected][1:v]overlay={x}:{y}"
+    filters += "[out]"
+    cmd += ['-filter_complex', filters, '-map', '[out]', '-frames:v', str(count), '-r', str(fps)]
+    cmd += encoderArgs(encoder) + [output_path]
+
+    try:
+        result = subprocess.run(cmd)
+    except FileNotFoundError:
+        log(f"Error encoding {output_path}: ffmpeg executable not found", bcolors.ERROR)
+        return False
+    if result.returncode != 0:
+        log(f"Error encoding {output_path}: ffmpeg exited with code {result.returncode}", bcolors.ERROR)
+        return False
+    return True
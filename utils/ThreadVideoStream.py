@@ -4,12 +4,16 @@
 ## ThreadVideoCapture from https://pyimagesearch.com/2017/02/06/faster-video-file-fps-with-cv2-videocapture-and-opencv/
 
 from threading import Thread, Lock
-import time
-from queue import Queue
+from queue import Queue, Empty
 
+import time
 import cv2
 
 from utils.log_utils import log
+from utils.metrics import def_metrics
+
+# Pushed to the queue to signal the end of the stream
+_END_OF_STREAM = None
 
 class ThreadVideoBase:
     def __init__(self, path, queueSize):
@@ -18,15 +22,15 @@ class ThreadVideoBase:
         # initialize the queue used to store frames to write
         self.Q = Queue(maxsize=queueSize)
         self.stopped = False
+        self.thread = None
 
         self.lock = Lock()
 
     def start(self):
         # start a thread to read frames from the file video stream
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
-        time.sleep(0.5)
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
         return self
 
     def update(self):
@@ -40,14 +44,19 @@ class ThreadVideoBase:
         # indicate that the thread should be stopped
         with self.lock:
             self.stopped = True
-    
+
     def isStopped(self):
         with self.lock:
             return self.stopped
-        
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
     def release(self):
         self.stop()
-        time.sleep(0.5)
+        self.join()
         self.stream.release()
 
 class ThreadVideoWriter(ThreadVideoBase):
@@ -56,17 +65,31 @@ class ThreadVideoWriter(ThreadVideoBase):
 
         self.stream = cv2.VideoWriter(path, format, fps, size)
 
-    
     def update(self):
+        # Blocks until a frame is available, ends when the sentinel is found
         while True:
-            if self.isStopped():
+            frame = self.Q.get()
+            if frame is _END_OF_STREAM:
                 return
-            
-            if not self.Q.empty():
-                self.stream.write(self.Q.get())
+            start = time.perf_counter()
+            self.stream.write(frame)
+            def_metrics.add('writer/encode', time.perf_counter() - start, 1)
 
     def write(self, frame):
+        # Time blocked here means that encoding is slower than the producer
+        def_metrics.queue('writer/queue', self.Q.qsize())
+        start = time.perf_counter()
         self.Q.put(frame)
+        def_metrics.add('writer/write_wait', time.perf_counter() - start)
+
+    def release(self):
+        # Sentinel goes after all queued frames, so all of them are written before closing the file
+        self.stop()
+        if self.thread is not None:
+            self.Q.put(_END_OF_STREAM)
+        self.join()
+        # False if the writer reports that the video could not be written (FFmpegEncoder), cv2.VideoWriter returns None
+        return self.stream.release() is not False
 
 class ThreadVideoCapture(ThreadVideoBase):
     def __init__(self, path, frameSkip = 1, queueSize=120):
@@ -81,38 +104,61 @@ class ThreadVideoCapture(ThreadVideoBase):
             return
 
     def update(self):
-        # keep looping infinitely
-        total_frames = int(self.stream.get(cv2.CAP_PROP_FRAME_COUNT))
-        
-        for frame_index in range(0, total_frames, self.frameSkip):
-            self.stream.set(cv2.CAP_PROP_FRAME_COUNT, frame_index)
-
-            # if the thread indicator variable is set, stop the thread
-            if self.isStopped():
-                return
-            
-            # ensure the queue has room in it
-            while self.Q.full():
-                time.sleep(0.5)
-
-            # read the next frame from the file
-            (grabbed, frame) = self.stream.read()
-            # if the `grabbed` boolean is `False`, then we have
-            # reached the end of the video file
-            if not grabbed:
-                self.stop()
-                return
-            # add the frame to the queue
-            self.Q.put(frame)
-
-        self.stop()
+        # Starts from current position so that a seek done before start() is honoured
+        frame_index = int(self.stream.get(cv2.CAP_PROP_POS_FRAMES))
+        start = time.perf_counter()
+
+        try:
+            # keep looping infinitely
+            while True:
+                # if the thread indicator variable is set, stop the thread
+                if self.isStopped():
+                    return
+
+                # grab() decodes the next frame without color conversion nor copy. If it fails
+                # we have reached the end of the video file
+                if not self.stream.grab():
+                    return
+
+                # Only one of each frameSkip frames is retrieved and queued
+                if frame_index % self.frameSkip == 0:
+                    (grabbed, frame) = self.stream.retrieve()
+                    if not grabbed:
+                        return
+                    # Decode time includes the frames grabbed but not retrieved since the previous one
+                    def_metrics.add('capture/decode', time.perf_counter() - start, 1)
+                    # add the frame to the queue, blocks while the queue is full
+                    self.Q.put((frame_index, frame))
+                    start = time.perf_counter()
+
+                frame_index += 1
+        finally:
+            self.Q.put(_END_OF_STREAM)
+
+    def readIndexed(self):
+        # return next (frame_index, frame) in the queue, blocks until it is available.
+        # frame_index is the real position of the frame in the video file
+        def_metrics.queue('capture/queue', self.Q.qsize())
+        item = self.Q.get()
+        if item is _END_OF_STREAM:
+            # Keep the sentinel so that following calls do not block
+            self.Q.put(_END_OF_STREAM)
+            return None, None
+        return item
 
     def read(self):
-        # return next frame in the queue
-        while self.Q.empty() and not self.isStopped():
-            time.sleep(0.5)
-
-        if self.Q.empty() and self.isStopped():
-            return None
-        else:
-            return self.Q.get()
+        # return next frame in the queue, blocks until it is available
+        return self.readIndexed()[1]
+
+    def release(self):
+        self.stop()
+        # Empty the queue so that a producer blocked on a full queue can finish
+        while self.thread is not None and self.thread.is_alive():
+            try:
+                while True:
+                    self.Q.get_nowait()
+            except Empty:
+                pass
+            self.thread.join(timeout=0.1)
+        self.thread = None
+        self.stream.release()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Compact storage of per frame data as NumPy arrays
+"""
+
+import os
+
+import numpy as np
+
+################################
+#    Run length encoding stuff #
+################################
+
+"""
+    Encodes sorted frame indexes as runs [first, last] of indexes separated by step frames
+    (motion is usually detected in consecutive sampled frames)
+"""
+def encodeRuns(indices, step):
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != step)
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [len(indices) - 1]))
+    return np.stack((indices[starts], indices[ends]), axis=1).tolist()
+
+def decodeRuns(runs, step):
+    if len(runs) == 0:
+        return np.empty(0, dtype=np.int32)
+    return np.concatenate([np.arange(first, last + 1, step, dtype=np.int32) for first, last in runs])
+
+################################
+#       Frames NPZ stuff       #
+################################
+
+"""
+    Stores a dict of {video: (frame_indices, speeds)} as flat arrays in a single .npz file.
+    frame_indices are stored as int32 and speeds as uint8
+"""
+def dumpFramesNpz(file_path, frames_dict):
+    videos = list(frames_dict.keys())
+    lengths = [len(frame_indices) for frame_indices, _ in frames_dict.values()]
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+    frames = np.concatenate([frame_indices for frame_indices, _ in frames_dict.values()]).astype(np.int32) if videos else np.empty(0, dtype=np.int32)
+    speeds = np.concatenate([speeds for _, speeds in frames_dict.values()]).astype(np.uint8) if videos else np.empty(0, dtype=np.uint8)
+
+    # np.savez adds the extension if missing, temporary file keeps it so the name is known
+    tmp_path = f'{os.path.splitext(file_path)[0]}.tmp.npz'
+    np.savez(tmp_path, videos=np.array(videos, dtype=np.str_), offsets=offsets, frames=frames, speeds=speeds)
+    os.replace(tmp_path, file_path)
+
+"""
+    Parses a file stored with dumpFramesNpz, per video arrays are views of the flat arrays
+"""
+def parseFramesNpz(file_path):
+    with np.load(file_path) as data:
+        videos, offsets, frames, speeds = data['videos'], data['offsets'], data['frames'], data['speeds']
+
+    return {str(video): (frames[offsets[index]:offsets[index+1]], speeds[offsets[index]:offsets[index+1]])
+            for index, video in enumerate(videos)}
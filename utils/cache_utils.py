@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Append only cache files in JSON Lines format. First line is a header with the type of data stored ('dict' or 'list'),
+    then each line is a record: [key, value] for dicts (later records override previous ones) or the item for lists.
+    Files ending in .yaml are handled with yaml_utils so old caches can still be used.
+"""
+
+import os
+import json
+
+from utils.yaml_utils import parseYaml, dumpYaml
+
+################################
+#     JSON Lines cache stuff   #
+################################
+
+def _header(data_type):
+    return json.dumps({'cache': data_type}) + '\n'
+
+def _record(key, value):
+    return json.dumps([key, value], separators=(',', ':')) + '\n'
+
+"""
+    Path to the YAML version of a cache file, used to migrate old caches
+"""
+def legacyYamlPath(file_path):
+    return os.path.splitext(file_path)[0] + '.yaml'
+
+def cacheExists(file_path):
+    return os.path.exists(file_path) or os.path.exists(legacyYamlPath(file_path))
+
+def parseCache(file_path):
+    if file_path.endswith('.yaml'):
+        return parseYaml(file_path)
+    if not os.path.exists(file_path) and os.path.exists(legacyYamlPath(file_path)):
+        return parseYaml(legacyYamlPath(file_path))
+
+    with open(file_path) as file:
+        header = json.loads(file.readline())
+        data = {} if header['cache'] == 'dict' else []
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line might be incomplete if the process was killed while appending
+                continue
+            if isinstance(data, dict):
+                data[record[0]] = record[1]
+            else:
+                data.append(record)
+    return data
+
+def dumpCache(file_path, data, mode = "w"):
+    if file_path.endswith('.yaml'):
+        return dumpYaml(file_path, data, mode)
+
+    data_type = 'dict' if isinstance(data, dict) else 'list'
+    lines = [_record(key, value) for key, value in data.items()] if data_type == 'dict' else [json.dumps(item) + '\n' for item in data]
+
+    if 'a' in mode and os.path.exists(file_path):
+        with open(file_path, 'a') as file:
+            file.writelines(lines)
+        return
+
+    # Written to a temporary file and then moved so that the cache is never left half written
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(_header(data_type))
+        file.writelines(lines)
+    os.replace(tmp_path, file_path)
+
+"""
+    Appends a single key/value record to a dict cache, without rewriting the rest of the file
+"""
+def appendCache(file_path, key, value):
+    if file_path.endswith('.yaml'):
+        return dumpYaml(file_path, {key: value}, 'a')
+
+    # Old YAML cache is migrated before appending to it
+    if not os.path.exists(file_path) and os.path.exists(legacyYamlPath(file_path)):
+        dumpCache(file_path, parseYaml(legacyYamlPath(file_path)), 'w')
+
+    new_file = not os.path.exists(file_path)
+    with open(file_path, 'a') as file:
+        if new_file:
+            file.write(_header('dict'))
+        file.write(_record(key, value))
+        file.flush()
+
+"""
+    Rewrites the cache file keeping only the last record of each key
+"""
+def compactCache(file_path):
+    if file_path.endswith('.yaml') or not os.path.exists(file_path):
+        return
+    dumpCache(file_path, parseCache(file_path), 'w')
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Fingerprints used to check if a cache entry is still valid
+"""
+
+import os
+import json
+import hashlib
+
+"""
+    Fingerprint of a file based on its size and modification time, the file content is not read
+"""
+def fileFingerprint(file_path):
+    stat = os.stat(file_path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+"""
+    Short hash of a dict of parameters (any JSON serializable data)
+"""
+def paramsFingerprint(params):
+    serialized = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Sequential frame selection: decodes each video once from front to back and only retrieves
+    (converts to BGR) the frames that are requested
+"""
+
+import cv2
+
+from utils.log_utils import log, bcolors
+
+# Gaps (in frames) bigger than this are jumped over with a seek instead of grabbing frame by frame.
+# OpenCV seeks to the previous keyframe and decodes forward from there, so it only pays off when
+# the gap is bigger than the GOP of the camera (usually 1-10 seconds of video)
+def_seek_threshold = 250
+
+"""
+    Generator that yields (frame_index, frame) for each of the requested frame indexes of the video.
+    frame_indices: sorted list of frame indexes to extract from the video
+    seek_threshold: gap in frames from which a seek is used instead of grab() calls
+    seek: False to always grab() forward. OpenCV seeks by time using the average fps, so in videos with variable frame
+          rate (see utils/video_probe.py constant_frame_rate) a seek lands on another frame
+"""
+def selectFrames(video_path, frame_indices, seek_threshold = def_seek_threshold, seek = True):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        log(f"Error opening video {video_path}", bcolors.ERROR)
+        return
+
+    position = 0 # Index of the next frame to be decoded
+    frame = None
+    try:
+        for frame_index in frame_indices:
+            frame_index = int(frame_index)
+            # Same frame requested twice, no need to decode it again
+            if frame_index == position - 1 and frame is not None:
+                yield frame_index, frame
+                continue
+
+            if seek and frame_index - position > seek_threshold:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+                position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+            # Decode (without color conversion) frames that are not needed
+            while position < frame_index:
+                if not cap.grab():
+                    log(f"Problem reading frame {position} from {video_path}", bcolors.ERROR)
+                    return
+                position += 1
+
+            if not cap.grab():
+                log(f"Problem reading frame {frame_index} from {video_path}", bcolors.ERROR)
+                return
+            position += 1
+
+            ret, frame = cap.retrieve()
+            if not ret:
+                log(f"Problem retrieving frame {frame_index} from {video_path}", bcolors.ERROR)
+                return
+            yield frame_index, frame
+    finally:
+        cap.release()
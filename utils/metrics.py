@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Throughput metrics of the pipeline: timers (with the frames processed, to get fps), counters (cache hits and
+    misses), queue depths of the threaded video streams, per video timers and CPU time of each worker process.
+    Each process accumulates its own metrics in def_metrics. Worker tasks are run through measured(), which returns
+    a picklable snapshot with the result that the main process merges with def_metrics.merge().
+    Timers are named '<component>/<name>': capture/decode and writer/encode are measured by the video streams,
+    timetags/* and render/* by the detection and rendering loops (*_wait timers are the time blocked on a stream) and
+    stage/* are the wall times of each handle* stage. Timers with frames give the fps of that part of the pipeline
+"""
+
+import os
+import json
+import resource
+import threading
+from copy import deepcopy
+
+import time
+from tqdm import tqdm
+
+from utils.log_utils import log, bcolors
+
+def_progress = True  # Live tqdm progress bars in the main process
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}    # name: {'seconds', 'calls', 'frames'}
+            self.counters = {}  # name: value
+            self.queues = {}    # name: {'samples', 'total', 'max'}
+            self.videos = {}    # video: {name: {'seconds', 'frames'}}
+            self.workers = {}   # pid: {'tasks', 'wall', 'cpu_user', 'cpu_system', 'children_cpu'}
+
+    """
+        Adds seconds (and frames processed in that time) to the timer name
+    """
+    def add(self, name, seconds, frames = 0):
+        with self.lock:
+            timer = self.timers.setdefault(name, {'seconds': 0.0, 'calls': 0, 'frames': 0})
+            timer['seconds'] += seconds
+            timer['calls'] += 1
+            timer['frames'] += frames
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    """
+        Records a sample of the depth of the queue name
+    """
+    def queue(self, name, depth):
+        with self.lock:
+            queue = self.queues.setdefault(name, {'samples': 0, 'total': 0, 'max': 0})
+            queue['samples'] += 1
+            queue['total'] += depth
+            queue['max'] = max(queue['max'], depth)
+
+    def video(self, video, name, seconds, frames = 0):
+        with self.lock:
+            timer = self.videos.setdefault(video, {}).setdefault(name, {'seconds': 0.0, 'frames': 0})
+            timer['seconds'] += seconds
+            timer['frames'] += frames
+
+    """
+        Frames per second of the timer name, None if nothing was measured
+    """
+    def fps(self, name):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None or timer['seconds'] <= 0:
+                return None
+            return timer['frames'] / timer['seconds']
+
+    """
+        Copy of all metrics as plain dicts (picklable, JSON serializable)
+    """
+    def snapshot(self):
+        with self.lock:
+            return deepcopy({'timers': self.timers, 'counters': self.counters, 'queues': self.queues,
+                             'videos': self.videos, 'workers': self.workers})
+
+    """
+        Accumulates a snapshot (usually from a worker process) into these metrics
+    """
+    def merge(self, snapshot):
+        def accumulate(target, source):
+            for key, value in source.items():
+                if isinstance(value, dict):
+                    accumulate(target.setdefault(key, {}), value)
+                elif key == 'max':
+                    target[key] = max(target.get(key, 0), value)
+                else:
+                    target[key] = target.get(key, 0) + value
+
+        with self.lock:
+            for section in ('timers', 'counters', 'queues', 'videos', 'workers'):
+                accumulate(getattr(self, section), snapshot.get(section, {}))
+
+    """
+        Snapshot with derived values: fps of each timer, mean depth of each queue and CPU time of this process
+    """
+    def report(self):
+        report = self.snapshot()
+        for timer in report['timers'].values():
+            timer['fps'] = timer['frames'] / timer['seconds'] if timer['frames'] and timer['seconds'] > 0 else None
+        for queue in report['queues'].values():
+            queue['mean'] = queue['total'] / queue['samples'] if queue['samples'] else 0
+        usage, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        report['main'] = {'pid': os.getpid(), 'cpu_user': usage.ru_utime, 'cpu_system': usage.ru_stime,
+                          'children_cpu': children.ru_utime + children.ru_stime, 'max_rss_kb': usage.ru_maxrss}
+        return report
+
+def_metrics = Metrics()
+
+"""
+    Sets the configuration of metrics. Has to be called before creating worker processes
+"""
+def setupMetrics(progress = True):
+    global def_progress
+    def_progress = progress
+
+"""
+    Runs function(args) in a worker process with clean metrics. Returns (result, snapshot) where snapshot includes the
+    wall and CPU time of the task under the pid of the worker (children_cpu is the CPU of finished ffmpeg subprocesses).
+    To be used with functools.partial(measured, function) in Pool calls
+"""
+def measured(function, args):
+    def_metrics.reset()
+    start = time.perf_counter()
+    usage, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    result = function(args)
+
+    end_usage, end_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    def_metrics.workers[str(os.getpid())] = {
+        'tasks': 1, 'wall': time.perf_counter() - start,
+        'cpu_user': end_usage.ru_utime - usage.ru_utime, 'cpu_system': end_usage.ru_stime - usage.ru_stime,
+        'children_cpu': (end_children.ru_utime + end_children.ru_stime) - (children.ru_utime + children.ru_stime)}
+    return result, def_metrics.snapshot()
+
+"""
+    tqdm progress bar over iterable, disabled with setupMetrics(progress=False)
+"""
+def progress(iterable = None, total = None, desc = None, unit = 'video'):
+    return tqdm(iterable, total=total, desc=desc, unit=unit, disable=not def_progress, dynamic_ncols=True)
+
+"""
+    Postfix for progress bars with the fps of the frame stages measured so far
+"""
+def fpsPostfix(names):
+    postfix = {}
+    for name in names:
+        fps = def_metrics.fps(name)
+        if fps is not None:
+            postfix[f"{name.split('/')[-1]}_fps"] = f'{fps:.0f}'
+    return postfix
+
+"""
+    Writes the report of def_metrics as JSON and logs the fps of the frame stages
+"""
+def writeMetricsReport(report_file):
+    report = def_metrics.report()
+    os.makedirs(os.path.dirname(report_file) or '.', exist_ok=True)
+    with open(report_file, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    for name, timer in sorted(report['timers'].items()):
+        if timer['fps'] is not None:
+            log(f"  {name}: {timer['frames']} frames in {timer['seconds']:.1f} s, {timer['fps']:.1f} FPS")
+    log(f"Metrics report stored in {report_file}.", bcolors.OKCYAN)
+    return report
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Motion detectors used to find timetags. All of them share the same interface: detect(frame) returns
+    (motion, motion_mask) for each processed frame and update(frame) only updates the background model (used
+    when the frame is known to be static). Detectors are created by name with createDetector, see def_detectors.
+    Intermediate images are written into buffers allocated with the first frame, so processing a frame makes
+    no allocation. The mask returned is one of these buffers, valid until next frame is processed
+"""
+
+import cv2
+import numpy as np
+
+"""
+    Reusable image with the given name in buffers, allocated the first time (or if shape changes)
+"""
+def _buffer(buffers, name, shape, dtype = np.uint8):
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[name] = np.empty(shape, dtype=dtype)
+    return buffer
+
+"""
+    Base class, subclasses implement mask(frame) returning a binary (0/255) motion mask. Small spots are removed
+    with an opening (iterations of erode with a kernel x kernel rect and then the same iterations of dilate, computed
+    as a single opening with the equivalent rect) and motion is detected when the mask sum is over threshold
+"""
+class MotionDetector:
+    def __init__(self, threshold, kernel = 3, iterations = 4):
+        self.threshold = threshold
+        size = (kernel - 1) * iterations + 1
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+        self.iterations = iterations
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype = np.uint8):
+        return _buffer(self.buffers, name, shape, dtype)
+
+    def mask(self, frame):
+        raise NotImplementedError
+
+    def detect(self, frame):
+        motion_mask = self.mask(frame)
+        if self.iterations > 0:
+            motion_mask = cv2.morphologyEx(motion_mask, cv2.MORPH_OPEN, self.kernel, dst=self.buffer('opened', motion_mask.shape))
+        # Mask is binary (0/255), same as np.sum(motion_mask) > threshold without the int64 reduction
+        return cv2.countNonZero(motion_mask) * 255 > self.threshold, motion_mask
+
+    def update(self, frame):
+        self.mask(frame)
+
+"""
+    K-nearest neighbours background subtraction
+"""
+class KNNDetector(MotionDetector):
+    def __init__(self, threshold, history = 300, kernel = 3, iterations = 4):
+        super().__init__(threshold, kernel, iterations)
+        self.fgbg = cv2.createBackgroundSubtractorKNN(history=history, detectShadows=False)
+
+    def mask(self, frame):
+        return self.fgbg.apply(frame, fgmask=self.buffer('mask', frame.shape[:2]))
+
+"""
+    Mixture of gaussians background subtraction
+"""
+class MOG2Detector(MotionDetector):
+    def __init__(self, threshold, history = 300, var_threshold = 16, kernel = 3, iterations = 4):
+        super().__init__(threshold, kernel, iterations)
+        self.fgbg = cv2.createBackgroundSubtractorMOG2(history=history, varThreshold=var_threshold, detectShadows=False)
+
+    def mask(self, frame):
+        return self.fgbg.apply(frame, fgmask=self.buffer('mask', frame.shape[:2]))
+
+"""
+    Difference with a running average of previous frames (grayscale). alpha is the weight of each new frame in the average
+"""
+class FrameDiffDetector(MotionDetector):
+    def __init__(self, threshold, alpha = 0.05, diff_threshold = 25, kernel = 3, iterations = 2):
+        super().__init__(threshold, kernel, iterations)
+        self.alpha = alpha
+        self.diff_threshold = diff_threshold
+        self.background = None
+
+    def mask(self, frame):
+        shape = frame.shape[:2]
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.buffer('gray', shape))
+        if self.background is None:
+            self.background = gray.astype(np.float32)
+        background = cv2.convertScaleAbs(self.background, dst=self.buffer('background', shape))
+        diff = cv2.absdiff(gray, background, dst=self.buffer('diff', shape))
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+        _, motion_mask = cv2.threshold(diff, self.diff_threshold, 255, cv2.THRESH_BINARY, dst=self.buffer('mask', shape))
+        return motion_mask
+
+"""
+    Magnitude of the dense optical flow (Farneback) between consecutive frames, computed on a frame scaled down to width
+    pixels. Pixels moving more than min_magnitude pixels are marked as motion
+"""
+class OpticalFlowDetector(MotionDetector):
+    def __init__(self, threshold, width = 160, min_magnitude = 1.0, kernel = 3, iterations = 1):
+        super().__init__(threshold, kernel, iterations)
+        self.width = width
+        self.min_magnitude = min_magnitude
+        self.frames = 0
+
+    def mask(self, frame):
+        shape = (max(round(frame.shape[0] * self.width / frame.shape[1]), 1), self.width)
+        small = cv2.resize(frame, (shape[1], shape[0]), dst=self.buffer('small', shape + (3,)), interpolation=cv2.INTER_AREA)
+        # Two gray buffers are used alternatively as current and previous frame
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.buffer(f'gray{self.frames % 2}', shape))
+        previous = self.buffer(f'gray{(self.frames + 1) % 2}', shape)
+        self.frames += 1
+
+        motion_mask = self.buffer('mask', shape)
+        if self.frames == 1:
+            motion_mask[:] = 0
+            return motion_mask
+
+        flow = cv2.calcOpticalFlowFarneback(previous, gray, self.buffer('flow', shape + (2,), np.float32), 0.5, 2, 9, 2, 5, 1.1, 0)
+        flow_x, flow_y = self.buffer('flow_x', shape, np.float32), self.buffer('flow_y', shape, np.float32)
+        cv2.split(flow, [flow_x, flow_y])
+        magnitude = cv2.magnitude(flow_x, flow_y, magnitude=self.buffer('magnitude', shape, np.float32))
+        return cv2.compare(magnitude, self.min_magnitude, cv2.CMP_GT, dst=motion_mask)
+
+"""
+    Cheap motion gate: compares a heavily downsampled grayscale version of each frame with the previous one.
+    width: width of the compared frames; pixel_threshold: gray level difference for a pixel to be considered changed;
+    min_pixels: changed pixels needed to consider that the frame changed
+"""
+class MotionGate:
+    def __init__(self, width = 64, pixel_threshold = 12, min_pixels = 2):
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_pixels = min_pixels
+        self.frames = 0
+        self.buffers = {}
+
+    def buffer(self, name, shape):
+        return _buffer(self.buffers, name, shape)
+
+    def changed(self, frame):
+        shape = (max(round(frame.shape[0] * self.width / frame.shape[1]), 1), self.width)
+        small = cv2.resize(frame, (shape[1], shape[0]), dst=self.buffer('small', shape + (3,)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.buffer(f'gray{self.frames % 2}', shape))
+        previous = self.buffer(f'gray{(self.frames + 1) % 2}', shape)
+        self.frames += 1
+        if self.frames == 1:
+            return True
+
+        diff = cv2.absdiff(gray, previous, dst=self.buffer('diff', shape))
+        cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=diff)
+        return cv2.countNonZero(diff) >= self.min_pixels
+
+def_detectors = {
+    'knn': KNNDetector,
+    'mog2': MOG2Detector,
+    'framediff': FrameDiffDetector,
+    'opticalflow': OpticalFlowDetector,
+}
+
+"""
+    Creates the detector registered as name in def_detectors, params are passed to its constructor
+"""
+def createDetector(name, threshold, params = {}):
+    if name not in def_detectors:
+        raise ValueError(f"Unknown motion detector '{name}', available: {', '.join(def_detectors.keys())}")
+    return def_detectors[name](threshold, **params)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Overlays drawn on the accelerated videos. Text is rasterized once into small BGRA sprites that are then
+    blended into each frame in place, so drawing an overlay costs a multiply and an add over a few thousand pixels
+"""
+
+from datetime import timedelta
+
+import cv2
+import numpy as np
+
+def_font = cv2.FONT_HERSHEY_SIMPLEX
+def_font_scale = 1
+def_font_thickness = 2
+def_margin = 10  # Pixels between the overlays and the border of the frame
+
+"""
+    Small BGRA image blended in place into frames. Blending weights are computed once: the premultiplied color and
+    the weight of the frame (255-alpha), so each frame only needs a multiply and an add on the sprite area
+"""
+class Sprite:
+    def __init__(self, bgra):
+        self.bgra = bgra
+        self.height, self.width = bgra.shape[:2]
+        alpha = cv2.merge([bgra[:, :, 3]] * 3)
+        self.premultiplied = cv2.multiply(np.ascontiguousarray(bgra[:, :, :3]), alpha, scale=1/255)
+        self.inverse_alpha = cv2.subtract(np.full_like(alpha, 255), alpha)
+        self.buffer = np.empty_like(alpha)
+
+    """
+        Draws the sprite in place with its top left corner at (x, y), parts out of the frame are clipped
+    """
+    def blend(self, frame, x, y):
+        frame_height, frame_width = frame.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + self.width, frame_width), min(y + self.height, frame_height)
+        if x0 >= x1 or y0 >= y1:
+            return frame
+
+        roi = frame[y0:y1, x0:x1]
+        sprite = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        buffer = self.buffer[sprite]
+        cv2.multiply(roi, self.inverse_alpha[sprite], dst=buffer, scale=1/255)
+        cv2.add(buffer, self.premultiplied[sprite], dst=roi)
+        return frame
+
+"""
+    Renders text into a sprite, same look as cv2.putText with the same parameters.
+    text_height, baseline: height above and below the baseline, to align sprites of different texts (those of the
+    text by default)
+"""
+def renderText(text, color, font = def_font, scale = def_font_scale, thickness = def_font_thickness, text_height = None, baseline = None):
+    (text_width, height), text_baseline = cv2.getTextSize(text, font, scale, thickness)
+    text_height = height if text_height is None else text_height
+    baseline = text_baseline if baseline is None else baseline
+    pad = thickness
+    size = (text_height + baseline + 2*pad, text_width + 2*pad)
+    # Text is drawn in white to get its coverage (antialiased edges) as alpha
+    alpha = np.zeros(size, dtype=np.uint8)
+    cv2.putText(alpha, text, (pad, text_height + pad), font, scale, 255, thickness)
+    bgra = np.zeros(size + (4,), dtype=np.uint8)
+    bgra[:, :, :3] = color
+    bgra[:, :, 3] = alpha
+    return Sprite(bgra)
+
+"""
+    Speed labels on the top right corner of the frames. labels: {speed: (text, color)} with the label of each speed.
+    Labels are aligned to the widest one so that none of them goes out of the frame
+"""
+class SpeedOverlay:
+    def __init__(self, labels, frame_size):
+        frame_width, _ = frame_size
+        self.labels = {speed: renderText(text, color) for speed, (text, color) in labels.items()}
+
+        pad = def_font_thickness
+        label_width = max((label.width - 2*pad for label in self.labels.values()), default=0)
+        self.position = (frame_width - label_width - def_margin - pad, def_margin - pad)
+
+    """
+        (bgra, x, y) of the label of speed to be composed outside Python (ffmpeg overlay filter), None if it has no label
+    """
+    def labelImage(self, speed):
+        label = self.labels.get(speed)
+        if label is None:
+            return None
+        return (label.bgra, *self.position)
+
+    def apply(self, frame, speed):
+        label = self.labels.get(speed)
+        if label is not None:
+            label.blend(frame, *self.position)
+        return frame
+
+"""
+    Date and time of each frame on the top left corner, start_date is the date of the first frame of the video and fps
+    its frame rate. Characters are rendered once with the same height and fixed width, the text of a frame is composed
+    from them into a line sprite that is only rebuilt when the text changes
+"""
+class ClockOverlay:
+    def __init__(self, start_date, fps, color = (255,255,255), date_format = '%Y-%m-%d %H:%M:%S'):
+        self.start_date = start_date
+        self.fps = fps
+        self.date_format = date_format
+        characters = '0123456789-: /'
+        (_, text_height), baseline = cv2.getTextSize(characters, def_font, def_font_scale, def_font_thickness)
+        self.glyphs = {character: renderText(character, color, text_height=text_height, baseline=baseline) for character in characters}
+        self.glyph_width = max(glyph.width for glyph in self.glyphs.values())
+        self.glyph_height = text_height + baseline + 2*def_font_thickness
+        self.text = None
+        self.line = None
+
+    def compose(self, text):
+        if self.line is None or self.line.width != len(text) * self.glyph_width:
+            self.line = Sprite(np.zeros((self.glyph_height, len(text) * self.glyph_width, 4), dtype=np.uint8))
+        self.line.premultiplied[:] = 0
+        self.line.inverse_alpha[:] = 255
+        for index, character in enumerate(text):
+            glyph = self.glyphs.get(character)
+            if glyph is not None:
+                x = index * self.glyph_width
+                self.line.premultiplied[:, x:x+glyph.width] = glyph.premultiplied
+                self.line.inverse_alpha[:, x:x+glyph.width] = glyph.inverse_alpha
+        self.text = text
+
+    def apply(self, frame, frame_index):
+        text = (self.start_date + timedelta(seconds=frame_index / self.fps)).strftime(self.date_format)
+        if text != self.text:
+            self.compose(text)
+        self.line.blend(frame, def_margin - def_font_thickness, def_margin - def_font_thickness)
+        return frame
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Regions of interest (ROI) where motion is detected. The ROI table is a list of entries loaded from a YAML file,
+    the first entry whose date range contains the date of the video (taken from its path) is used. Each entry defines
+    the region as a rectangle, as margins removed from each border or as a polygon (see roi_table.yaml).
+    Crop, scale and mask of a video are computed once (VideoRoi) and applied to each frame into a reusable buffer
+"""
+
+import re
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from utils.yaml_utils import parseYaml
+
+# Date of the video from paths like .../202405/18d/17h/52m04s_auto_300s_hd.mp4 (hour can also be in the filename)
+def_video_date_regex = re.compile(r'(\d{4})(\d{2})/(\d{2})d/(\d{2})h/?(\d{2})m(\d{2})s')
+
+_REGION_KEYS = ('rect', 'margins', 'polygon')
+
+"""
+    Date of the video taken from its path, None if the path does not follow the camera folder structure
+"""
+def videoDate(video_path):
+    match = def_video_date_regex.search(video_path)
+    if match is None:
+        return None
+    return datetime(*(int(value) for value in match.groups()))
+
+def _parse_date(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+"""
+    Checks the entries of a ROI table, dates are normalized to ISO strings so that the table can be fingerprinted
+"""
+def checkRoiTable(roi_table):
+    checked = []
+    for index, entry in enumerate(roi_table):
+        regions = [key for key in _REGION_KEYS if key in entry]
+        if len(regions) != 1:
+            raise ValueError(f"ROI entry {index} needs exactly one of {', '.join(_REGION_KEYS)}, found: {regions}")
+        entry = dict(entry)
+        for key in ('from', 'to'):
+            if entry.get(key) is not None:
+                entry[key] = _parse_date(entry[key]).isoformat(sep=' ')
+        checked.append(entry)
+    return checked
+
+def parseRoiTable(file_path):
+    return checkRoiTable(parseYaml(file_path) or [])
+
+"""
+    First entry of the table that applies to the video. Entries match if the video date is in [from, to), a missing
+    limit matches any date. Videos whose date is unknown only match entries without limits
+"""
+def findRoiEntry(video_path, roi_table):
+    date = videoDate(video_path)
+    for entry in roi_table:
+        date_from, date_to = _parse_date(entry.get('from')), _parse_date(entry.get('to'))
+        if date is None and (date_from is not None or date_to is not None):
+            continue
+        if (date_from is None or date >= date_from) and (date_to is None or date < date_to):
+            return entry
+    return None
+
+"""
+    Crop (x, y, width, height), scaled size and mask of a ROI entry for a video of frame_size (width, height).
+    Polygons are cropped to their bounding box and pixels outside of them are set to black with a mask.
+    Frames are processed into a preallocated contiguous buffer, so apply() makes no allocation per frame
+"""
+class VideoRoi:
+    def __init__(self, entry, frame_size, scale = 1.0):
+        frame_width, frame_height = frame_size
+        polygon = None
+        if entry is None:
+            x, y, width, height = 0, 0, frame_width, frame_height
+        elif 'rect' in entry:
+            x, y, width, height = entry['rect']
+        elif 'margins' in entry:
+            left, top, right, bottom = entry['margins']
+            x, y, width, height = left, top, frame_width-right-left, frame_height-bottom-top
+        else:
+            polygon = np.array(entry['polygon'], dtype=np.float64).reshape(-1, 2)
+            x, y = np.floor(polygon.min(axis=0)).astype(int)
+            x_end, y_end = np.ceil(polygon.max(axis=0)).astype(int)
+            width, height = x_end - x, y_end - y
+
+        # Region is kept inside the frame
+        x, y = min(max(int(x), 0), frame_width - 1), min(max(int(y), 0), frame_height - 1)
+        width, height = max(min(int(width), frame_width - x), 1), max(min(int(height), frame_height - y), 1)
+
+        self.crop = (x, y, width, height)
+        self.scale = scale
+        # Same rounding as cv2.resize with fx/fy
+        self.size = (int(round(width * scale)), int(round(height * scale)))
+        self.buffer = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+
+        self.mask = None
+        if polygon is not None:
+            points = np.round((polygon - (x, y)) * (self.size[0] / width, self.size[1] / height)).astype(np.int32)
+            mask = np.zeros((self.size[1], self.size[0]), dtype=np.uint8)
+            cv2.fillPoly(mask, [points], 255)
+            self.mask = cv2.merge([mask, mask, mask])
+
+    """
+        Crops and scales a full frame into the buffer of the ROI, returns the buffer
+    """
+    def apply(self, frame):
+        x, y, width, height = self.crop
+        if self.scale != 1.0:
+            cv2.resize(frame[y:y+height, x:x+width], (0, 0), dst=self.buffer, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(self.buffer, frame[y:y+height, x:x+width])
+        return self.applyMask(self.buffer)
+
+    """
+        Sets pixels outside of the polygon to black in place, for frames already cropped and scaled (ffmpeg backend)
+    """
+    def applyMask(self, frame):
+        if self.mask is not None:
+            cv2.bitwise_and(frame, self.mask, dst=frame)
+        return frame
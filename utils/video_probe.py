@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Video metadata (fps, frame count and size) without decoding. MP4/MOV files are probed reading only the box
+    headers and the moov box (a few small reads even on network mounts), other files fall back to cv2.VideoCapture.
+    Results are stored in a metadata cache keyed by file fingerprint so that every stage shares them
+"""
+
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import time
+from datetime import timedelta
+
+import cv2
+
+from utils.log_utils import log, bcolors
+from utils.cache_utils import parseCache, appendCache, compactCache, cacheExists
+from utils.fingerprint_utils import fileFingerprint
+from utils.metrics import def_metrics
+
+# Stored with each cache entry, entries probed by other versions (fps was the nominal frame rate in version 1, no
+# constant_frame_rate in version 2) are probed again
+def_probe_version = 3
+
+################################
+#       MP4 parsing stuff      #
+################################
+
+"""
+    Iterates over the boxes in data[start:end], yields (type, payload_start, payload_end)
+"""
+def _boxes(data, start, end):
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield box_type, start + header, min(start + size, end)
+        start += size
+
+"""
+    Reads the moov box of the file without reading the media data (mdat) that can be before or after it
+"""
+def _read_moov(file):
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    position = 0
+    while position + 8 <= file_size:
+        file.seek(position)
+        header = file.read(16)
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - position
+        if size < header_size:
+            return None
+        if box_type == b'moov':
+            file.seek(position + header_size)
+            return file.read(size - header_size)
+        position += size
+    return None
+
+"""
+    Parses the video track of a moov box, returns dict with fps, total_frames, width and height or None
+"""
+def _parse_video_track(moov):
+    def find(start, end, path):
+        for box_type, payload_start, payload_end in _boxes(moov, start, end):
+            if box_type == path[0]:
+                if len(path) == 1:
+                    return payload_start, payload_end
+                return find(payload_start, payload_end, path[1:])
+        return None
+
+    for box_type, trak_start, trak_end in _boxes(moov, 0, len(moov)):
+        if box_type != b'trak':
+            continue
+        hdlr = find(trak_start, trak_end, [b'mdia', b'hdlr'])
+        if hdlr is None or moov[hdlr[0]+8:hdlr[0]+12] != b'vide':
+            continue
+
+        mdhd = find(trak_start, trak_end, [b'mdia', b'mdhd'])
+        stsd = find(trak_start, trak_end, [b'mdia', b'minf', b'stbl', b'stsd'])
+        stsz = find(trak_start, trak_end, [b'mdia', b'minf', b'stbl', b'stsz'])
+        stts = find(trak_start, trak_end, [b'mdia', b'minf', b'stbl', b'stts'])
+        if None in (mdhd, stsd, stsz, stts):
+            return None
+
+        version = moov[mdhd[0]]
+        timescale = struct.unpack_from('>I', moov, mdhd[0] + (20 if version == 1 else 12))[0]
+        # Visual sample entry: size, format, 6 reserved, data reference index, 16 predefined/reserved, width, height
+        width, height = struct.unpack_from('>HH', moov, stsd[0] + 8 + 32)
+        total_frames = struct.unpack_from('>I', moov, stsz[0] + 8)[0]
+
+        # Time to sample table as (count, delta) entries, its sum is the duration of the track. Frame rate is the average
+        # one (frames / duration) as reported by cv2.CAP_PROP_FPS, cameras write variable frame rate videos
+        entry_count = struct.unpack_from('>I', moov, stts[0] + 4)[0]
+        duration = 0
+        for index in range(entry_count):
+            count, delta = struct.unpack_from('>II', moov, stts[0] + 8 + index*8)
+            duration += count * delta
+        # Fragmented files have no samples in moov
+        if duration == 0 or timescale == 0 or total_frames == 0:
+            return None
+
+        # Frame index and time only map exactly with a constant frame rate (single stts entry), needed to seek by time
+        return {'fps': total_frames * timescale / duration, 'total_frames': total_frames, 'width': width, 'height': height,
+                'constant_frame_rate': entry_count == 1}
+    return None
+
+"""
+    Metadata of an MP4/MOV file from its moov box, None if it could not be parsed
+"""
+def probeMp4(video_path):
+    try:
+        with open(video_path, 'rb') as file:
+            moov = _read_moov(file)
+        return _parse_video_track(moov) if moov is not None else None
+    except (OSError, struct.error):
+        return None
+
+################################
+#       Probe/cache stuff      #
+################################
+
+"""
+    Metadata opening the video with OpenCV, slower but works with any container
+"""
+def probeCapture(video_path):
+    stream = cv2.VideoCapture(video_path)
+    metadata = {'fps': stream.get(cv2.CAP_PROP_FPS), 'total_frames': int(stream.get(cv2.CAP_PROP_FRAME_COUNT)),
+                'width': int(stream.get(cv2.CAP_PROP_FRAME_WIDTH)), 'height': int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                'constant_frame_rate': False}
+    stream.release()
+    return metadata
+
+"""
+    Returns dict with 'fps', 'total_frames', 'width', 'height' and 'constant_frame_rate' (False if unknown) of the video
+"""
+def probeVideo(video_path):
+    metadata = probeMp4(video_path)
+    if metadata is None:
+        metadata = probeCapture(video_path)
+    return metadata
+
+def probe_entry(video_path):
+    metadata = probeVideo(video_path)
+    metadata['file_fingerprint'] = fileFingerprint(video_path)
+    metadata['probe_version'] = def_probe_version
+    return video_path, metadata
+
+"""
+    Metadata of all video_files, those that are not in metadata_cache_file (or whose file changed) are probed in
+    parallel threads and stored in the cache. Returns {video: metadata}
+"""
+def handleVideoProbe(video_files, metadata_cache_file, max_workers):
+    start = time.time()
+
+    cached = parseCache(metadata_cache_file) if cacheExists(metadata_cache_file) else {}
+    metadata_dict = {}
+    pending = []
+    for video in video_files:
+        entry = cached.get(video)
+        if entry is not None and entry.get('file_fingerprint') == fileFingerprint(video) and entry.get('probe_version') == def_probe_version:
+            metadata_dict[video] = entry
+        else:
+            pending.append(video)
+
+    if pending:
+        with ThreadPoolExecutor(max_workers) as executor:
+            for video, metadata in executor.map(probe_entry, pending):
+                metadata_dict[video] = metadata
+                appendCache(metadata_cache_file, video, metadata)
+        compactCache(metadata_cache_file)
+
+    def_metrics.count('metadata_cache_hit', len(metadata_dict) - len(pending))
+    def_metrics.count('metadata_cache_miss', len(pending))
+    def_metrics.add('stage/video_probe', time.time()-start)
+    log(f"Metadata of {len(metadata_dict)} videos ({len(pending)} probed), took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).", bcolors.OKCYAN)
+    return metadata_dict
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Watch mode for live camera ingestion. The input folder is polled periodically and new videos are processed as
+    soon as the camera finishes writing them: timetags are only computed for the new videos, only their segments are
+    rendered and they are appended to the existing output videos by concatenation (no re-encoding).
+    Videos already appended to the outputs are stored in watch_state_file so the watch can be stopped and restarted.
+"""
+
+import os
+import time
+from datetime import timedelta
+
+from utils.log_utils import log, bcolors, logCoolMessage
+from utils.yaml_utils import dumpYaml
+from utils.cache_utils import parseCache, dumpCache, appendCache, cacheExists, compactCache
+from utils.array_utils import parseFramesNpz, dumpFramesNpz
+from utils.video_probe import handleVideoProbe
+from utils.metrics import writeMetricsReport
+
+from find_videos import find_videos
+from find_timetags import setupTimetags, loadTimestampsCache
+from accelerate import appendSegments
+from stream_pipeline import streamVideos
+
+# Seconds between two scans of the input folder
+def_watch_interval = 60
+
+"""
+    Returns the videos that were not appended yet and that the camera already finished writing, in chronological
+    order. A video is complete once its size did not change since last scan (or it was not modified in the last
+    interval seconds). Videos after one that is still being written are kept for next scan so that order is kept.
+    Empty videos not modified in the last interval seconds (aborted writes of the camera) are skipped.
+    sizes: file sizes found in the last scan, it is updated with the sizes of this one
+"""
+def find_new_videos(video_files, watch_state, sizes, interval):
+    last_video = max(watch_state.keys(), default = '')
+
+    new_videos = []
+    for video in sorted(video_files):
+        if video in watch_state:
+            continue
+        if video < last_video:
+            if video not in sizes:
+                log(f"Video {video} is older than the last appended one, it is ignored to keep the outputs in order.", bcolors.WARNING)
+            sizes[video] = None
+            continue
+
+        try:
+            stat = os.stat(video)
+        except FileNotFoundError:
+            break
+        if stat.st_size == 0 and time.time() - stat.st_mtime > interval:
+            # Will not be written anymore, it must not hold back the next videos
+            if sizes.get(video, 0) is not None:
+                log(f"Video {video} is empty, it is skipped.", bcolors.WARNING)
+            sizes[video] = None
+            continue
+        complete = stat.st_size > 0 and (sizes.get(video) == stat.st_size or time.time() - stat.st_mtime > interval)
+        sizes[video] = stat.st_size
+        if not complete:
+            break
+        new_videos.append(video)
+
+    return new_videos
+
+"""
+    Processes new_videos (in chronological order) and appends them to the output of each profile.
+    watch_state is updated with the new videos
+"""
+def appendVideos(new_videos, watch_state, watch_state_file, timestamp_dict, profiles, new_fps, before_seconds, after_seconds,
+                 max_workers, max_workers_accelerate, timestamp_videos_black_list, timestamps_cache_file, ffmpeg_cache_file, failed_videos_yaml,
+                 metadata_cache_file = None):
+    start = time.time()
+    logCoolMessage(f'Appending {len(new_videos)} new videos')
+    metadata_dict = handleVideoProbe(new_videos, metadata_cache_file, max_workers) if metadata_cache_file is not None else {}
+
+    frame_count_general = sum(entry['total_frames'] for entry in watch_state.values())
+    segment_lists, frames_dicts, failed, _ = streamVideos(new_videos, timestamp_dict, profiles, new_fps, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                                                          timestamp_videos_black_list, timestamps_cache_file, frame_count_general, metadata_dict)
+
+    # All outputs or none are updated, so that the videos can be processed again in next scan without being appended
+    # twice to any output. State is not updated (their timetags are already cached)
+    if not appendSegments(segment_lists, ffmpeg_cache_file):
+        return False
+
+    for profile, frames_dict in zip(profiles, frames_dicts):
+        if 'frames_cache_file' in profile:
+            if os.path.exists(profile['frames_cache_file']):
+                frames_dict = {**parseFramesNpz(profile['frames_cache_file']), **frames_dict}
+            dumpFramesNpz(profile['frames_cache_file'], frames_dict)
+
+    if failed:
+        log(f"Could not accelerate {len(failed)} videos.", bcolors.WARNING)
+        if failed_videos_yaml is not None:
+            dumpYaml(failed_videos_yaml, failed, 'a')
+
+    for video in new_videos:
+        watch_state[video] = {'total_frames': timestamp_dict[video]['total_frames']}
+        appendCache(watch_state_file, video, watch_state[video])
+    compactCache(timestamps_cache_file)
+
+    log(f"Appended {len(new_videos)} videos to {', '.join(segment_lists.keys())}, took {str(timedelta(seconds=time.time()-start))} (h:min:sec.mil).")
+    return True
+
+"""
+    Watches input_video_path until interrupted (Ctrl+C), new videos are appended to the outputs of the profiles.
+    On first run (or if any output is missing) all the videos found are rendered into new outputs. Metrics are written
+    to metrics_report_file (if given) after each batch of new videos
+"""
+def handleWatchFolder(input_video_path, input_video_extension, timestamps_cache_file, watch_state_file, timestamp_videos_black_list,
+                      profiles, new_fps, frame_skip, before_seconds, after_seconds, max_workers, max_workers_accelerate,
+                      decode_backend = 'opencv', interval = def_watch_interval, ffmpeg_cache_file = './cache/ffmpeg_video_list.txt', failed_videos_yaml = None,
+                      video_skip_patterns = [], metadata_cache_file = None, motion_gate = False,
+                      detector = 'knn', detector_params = {}, metrics_report_file = None):
+    logCoolMessage(f'Watching {input_video_path} for new videos')
+    setupTimetags(False, frame_skip, decode_backend, motion_gate, detector, detector_params)
+    timestamp_dict = loadTimestampsCache(timestamps_cache_file)
+
+    watch_state = parseCache(watch_state_file) if cacheExists(watch_state_file) else {}
+    if watch_state and not all(os.path.exists(profile['output']) for profile in profiles):
+        log(f"Some output videos are missing, all videos are rendered again.", bcolors.WARNING)
+        watch_state = {}
+    if not watch_state:
+        for profile in profiles:
+            if os.path.exists(profile['output']):
+                os.remove(profile['output'])
+        dumpCache(watch_state_file, watch_state, 'w')
+    log(f"{len(watch_state)} videos already appended to the outputs.")
+
+    sizes = {}
+    try:
+        while True:
+            video_files = find_videos(input_video_path, input_video_extension, max_workers, video_skip_patterns)
+            new_videos = find_new_videos(video_files, watch_state, sizes, interval)
+            if new_videos:
+                appendVideos(new_videos, watch_state, watch_state_file, timestamp_dict, profiles, new_fps, before_seconds, after_seconds,
+                             max_workers, max_workers_accelerate, timestamp_videos_black_list, timestamps_cache_file, ffmpeg_cache_file, failed_videos_yaml,
+                             metadata_cache_file)
+                if metrics_report_file is not None:
+                    writeMetricsReport(metrics_report_file)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        log(f"Stopped watching {input_video_path}, {len(watch_state)} videos appended to the outputs.")
+
+    return watch_state